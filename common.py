@@ -1,6 +1,7 @@
 """Common functionality."""
 
 import logging
+import queue
 import shlex
 from pathlib import Path
 
@@ -12,16 +13,23 @@ import pyutils.files
 import pyutils.misc
 # from pyutils.misc import fmt_size
 
+import dirstate
 import jsonfile
 import media
+import store
 import util
 from misctypes import Flag
+from player import PlayerError
 from synd import Feed
 from util import fmt_strings, fmt_table, time_fmt
 
 log = logging.getLogger(__name__)
 messager = util.Messager(__name__)
 
+# Progress saved by player thread, to be applied to cached feeds: tuples of
+# (feed directory, entry GUID, progress).
+_saved_progress = queue.SimpleQueue()
+
 WRAPPER = util.MultiWrapper(
     width=79,
     # width=-2,
@@ -83,11 +91,13 @@ def read_data(path):
 
 
 class View(util.AttrDict):
-    """A view to a feedlist. Giving '.' as flags stands for all flags."""
+    """A view to a feedlist. Giving '.' as flags stands for all flags. An
+    optional query further selects entries (see module `query`).
+    """
     DEFAULTS = dict(flags='foin', number=1, sortkey='fpD', sortkey2='SD')
 
     def __init__(self, directory=None, flags=None, number=None, sortkey=None,
-                 sortkey2=None):
+                 sortkey2=None, query=None):
         super().__init__()
         self.directory = directory
         if self.directory is not None:
@@ -106,9 +116,12 @@ class View(util.AttrDict):
         self.number = number
         self.sortkey = sortkey
         self.sortkey2 = sortkey2
+        self.query = query or None
 
     def __str__(self):
         s = '(f={flags}, n={number}, s={sortkey}, S={sortkey2}, {n})'
+        if self.query:
+            s = s[:-1] + ', q={query})'
         d = dict(self, flags=''.join(x.value for x in self.flags),
                  n=len(self.directory))
         return s.format(**d)
@@ -116,12 +129,12 @@ class View(util.AttrDict):
     def parse(self, s, sep=','):
         """Parse view string, update original view, and create a new one."""
         if not s:
-            s = ',,,'
+            s = ',,,,'
         lst = list(s.split(sep))
-        if len(lst) < 4:
-            lst += [''] * (4 - len(lst))  # Fill in missing parts.
+        if len(lst) < 5:
+            lst += [''] * (5 - len(lst))  # Fill in missing parts.
         try:
-            flags, number, sortkey, sortkey2 = lst
+            flags, number, sortkey, sortkey2, query = lst
         except ValueError:
             log.error('Cannot parse view: "%s"', s)
             raise
@@ -131,6 +144,7 @@ class View(util.AttrDict):
             number=int(number or self.number),
             sortkey=sortkey or self.sortkey,
             sortkey2=sortkey2 or self.sortkey2,
+            query=query or self.query,
             )
 
 
@@ -229,6 +243,8 @@ def show_entry(entry, verbose=0):
             (entry.title, 'Title'),
             (entry.description(), 'Desc'),
             (str(entry.get_tags()), 'Tags'),
+            (fmt_strings([bytes2human(entry.size()),
+                          fmt_duration(entry.duration())]), 'Files'),
             ])
         for enc in entry.encs():
             lst.append((fmt_strings([bytes2human(enc.length or 0), enc.typ,
@@ -278,26 +294,32 @@ def show_enclosures(entry):
         show_enclosure(enc)
 
 
-def download_enclosure(enc, maxsize=None):
+def download_enclosure(enc, maxsize=None, progress=True):
     """Download enclosure, return whether download was successful."""
     if enc.path.exists():
         log.debug('Already exists: %s', enc.path)
     elif enc.is_too_big(maxsize):
         log.warning('Download too big: %s: %s', bytes2human(enc.length or 0),
                     enc.path)
+    elif store.get_store() is not None and store.get_store().link(enc):
+        dirstate.invalidate(enc.path)
+        return True
     else:
         # messager.msg(truncate('Downloading {}: {}'.format(
         #     fmt_size(enc.length), enc.path)))
         # messager.msg('Downloading {}: {}'.format(fmt_size(enc.length),
         #                                          enc.path), truncate=True)
         try:
-            if enc.download():
+            if enc.download(progress=progress):
+                dirstate.invalidate(enc.path)
+                if store.get_store() is not None:
+                    store.get_store().add(enc.path, enc.href)
                 return True
             log.error('Download failed: %s', enc.path)
         except NotImplementedError:
             log.debug('Download not implemented: %s', enc)
         except KeyboardInterrupt:
-            log.error('Download interrupted: %s', enc)
+            log.error('Download interrupted, can be resumed: %s', enc)
     return False
 
 
@@ -308,11 +330,24 @@ def download_enclosures(entry, maxsize=None):
             print(pyutils.misc.ring_bell(), flush=True)
 
 
-def normalize_enclosure(enc, force=False):
-    """Normalize enclosure."""
+def dedup_enclosures(entry, enc_store):
+    """Add existing enclosure files to store. Return bytes reclaimed."""
+    return sum(enc_store.add(x.path, x.href, write=False)
+               for x in entry.encs() if x.path.exists())
+
+
+def normalize_enclosure(enc, force=False, quiet=False):
+    """Normalize enclosure, unless another thread or process is already
+    doing it. Return True if normalized here.
+    """
     if enc.path.exists():
         if force or not enc.is_normalized():
-            media.normalize_volume(enc.path)
+            with media.lock_file(enc.path):
+                if force or media.get_gain(enc.path) is None:
+                    media.normalize_volume(enc.path, quiet=quiet)
+                    dirstate.invalidate(enc.path)
+                    return True
+    return False
 
 
 def normalize_enclosures(entry, force=False):
@@ -323,11 +358,26 @@ def normalize_enclosures(entry, force=False):
             normalize_enclosure(enc, force=force)
 
 
-def play_enclosure(enc):
-    """Play enclosure."""
+def play_enclosure(enc, progressive=False, player=None):
+    """Play enclosure. If progressive, a missing file is downloaded while
+    playing. If a player.Player is given, a downloaded file is played there
+    without waiting, and its position is saved as entry progress.
+    """
     try:
+        if enc.path.exists() and player is not None:
+            messager.msg(f'Playing: {enc.path}')
+            try:
+                player.play(enc.path, start=enc.start_position(),
+                            gain=media.get_gain(enc.path),
+                            callback=progress_saver(enc.entry))
+                return 0
+            except PlayerError as e:
+                log.error('Player failed, falling back: %s', e)
         if enc.path.exists():
             exit_code = enc.play()
+        elif progressive:
+            messager.msg(f'Playing while downloading: {enc.path}')
+            exit_code = enc.play_progressive()
         else:
             messager.msg(f'File does not exist: {enc.path}')
             messager.msg(f'Streaming: {enc.href}')
@@ -339,7 +389,54 @@ def play_enclosure(enc):
         return None
 
 
-def play_enclosures(entry, set_flag=True):
+def progress_saver(entry):
+    """Return player callback that saves position as entry progress.
+
+    The callback runs in the player thread, so it does not touch the feed
+    object, which may be stale by then. The progress is merged into the feed
+    file on disk, and queued for `apply_saved_progress` in the main thread.
+    """
+    directory, guid = entry.feed.directory, entry.guid
+
+    def save(path, position):
+        log.debug('Saving progress: %s: %.3f', path, position)
+        position = round(position, 3)
+        save_progress(directory, guid, position)
+        _saved_progress.put((directory, guid, position))
+    return save
+
+
+def save_progress(directory, guid, progress):
+    """Set entry progress in feed file, rereading it to keep other changes."""
+    with Feed.write_lock:
+        feed = Feed.read(directory)
+        for entry in feed.entries:
+            if entry.guid == guid:
+                entry.progress = progress
+                feed.write()
+                return
+    log.warning('Cannot save progress, entry not found: %s: %s', directory,
+                guid)
+
+
+def apply_saved_progress(feeds):
+    """Apply progress saved by player to cached feeds, given as dictionary of
+    directory -> feed. Call from the thread that uses the feeds.
+    """
+    while True:
+        try:
+            directory, guid, progress = _saved_progress.get_nowait()
+        except queue.Empty:
+            return
+        feed = feeds.get(directory)
+        if feed is None:
+            continue
+        for entry in feed.entries:
+            if entry.guid == guid:
+                entry.progress = progress
+
+
+def play_enclosures(entry, set_flag=True, progressive=False, player=None):
     """Play entry enclosures."""
     # exit_codes = (play_enclosure(x) for x in entry.encs())
     # if set_flag and all(x == 0 for x in exit_codes):
@@ -351,9 +448,15 @@ def play_enclosures(entry, set_flag=True):
         if entry.flag in [Flag.fresh, Flag.important, Flag.new]:
             messager.msg('Flagging entry as opened')
             entry.set_flag(Flag.opened)
-        entry.progress = 1  # TODO: Should be set correctly (embed mpv).
+        if player is None:
+            entry.progress = 1  # Player reports real progress.
         entry.feed.write()
-    exit_codes = [play_enclosure(x) for x in entry.encs()]
+    encs = list(entry.encs())
+    if player is not None and len(encs) > 1:
+        log.warning('Playing only first of %i enclosures', len(encs))
+        encs = encs[:1]
+    exit_codes = [play_enclosure(x, progressive=progressive, player=player)
+                  for x in encs]
     return exit_codes
 
 
@@ -362,6 +465,7 @@ def remove_enclosure(enc):
     if enc.path.exists():
         messager.msg('Removing:', enc.path)
         pyutils.files.trash_or_rm(enc.path)
+        dirstate.invalidate(enc.path)
 
 
 def remove_enclosures(entry, set_flag=True):
@@ -0,0 +1,103 @@
+"""Cached status of files in feed directories."""
+
+import logging
+import os
+import threading
+import time
+from collections import namedtuple
+
+import media
+from misctypes import Gain
+
+log = logging.getLogger(__name__)
+
+MAX_AGE = 60  # Seconds to trust a snapshot of an unchanged directory.
+RACY = 2  # Seconds that directory modification time may lag behind.
+CHECK_INTERVAL = 1  # Seconds between directory modification time checks.
+
+FileStatus = namedtuple('FileStatus', ['size', 'gain'])
+
+_snapshots = {}  # Directory -> Snapshot.
+_lock = threading.Lock()
+
+
+class Snapshot():
+    """Names, sizes, and ReplayGain levels of files in a directory, read in
+    one pass. Changes in the directory show in its modification time; gain
+    attributes set meanwhile do not, so those who set them must invalidate
+    the snapshot (see `invalidate()`).
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        self.mtime = None  # Directory modification time in nanoseconds.
+        self.taken = time.time()
+        self.checked = self.taken  # Time of last validity check.
+        self.names = set()  # All directory entries.
+        self.files = {}  # Regular file name -> FileStatus.
+        try:
+            self.mtime = os.stat(directory).st_mtime_ns
+            with os.scandir(directory) as it:
+                for x in it:
+                    self.names.add(x.name)
+                    if x.is_file():
+                        self.files[x.name] = FileStatus(x.stat().st_size,
+                                                        read_gain(x.path))
+        except FileNotFoundError:
+            pass
+
+    def is_valid(self):
+        """Is snapshot still up to date? Directory changes within a moment
+        of taking it are not reliably seen, so those are not trusted.
+        """
+        now = time.time()
+        if now - self.taken > MAX_AGE:
+            return False
+        if self.mtime is not None and self.taken - self.mtime / 1e9 < RACY:
+            return False
+        if now - self.checked < CHECK_INTERVAL:
+            return True
+        try:
+            valid = os.stat(self.directory).st_mtime_ns == self.mtime
+        except FileNotFoundError:
+            valid = self.mtime is None
+        self.checked = now
+        return valid
+
+    def status(self, name):
+        """Return FileStatus for file, or None if it does not exist."""
+        return self.files.get(name)
+
+
+def read_gain(path):
+    """Read ReplayGain attribute of file, or None."""
+    try:
+        value = os.getxattr(path, media.GAIN_KEY)
+    except OSError:  # No attribute, or no support for them.
+        return None
+    try:
+        return Gain.parse(value.decode())
+    except ValueError:
+        log.error('Invalid ReplayGain value: %s', path)
+        return None
+
+
+def snapshot(directory):
+    """Return up-to-date snapshot of directory."""
+    with _lock:
+        snap = _snapshots.get(directory)
+    if snap is None or not snap.is_valid():
+        snap = Snapshot(directory)
+        with _lock:
+            _snapshots[directory] = snap
+    return snap
+
+
+def status(path):
+    """Return FileStatus for file, or None if it does not exist."""
+    return snapshot(path.parent).status(path.name)
+
+
+def invalidate(path):
+    """Forget snapshot of directory containing file."""
+    with _lock:
+        _snapshots.pop(path.parent, None)
@@ -0,0 +1,245 @@
+"""Persistent download queue."""
+
+import fcntl
+import logging
+import os
+import threading
+import time
+from concurrent.futures import wait
+from contextlib import contextmanager
+from pathlib import Path
+
+import pyutils.files
+
+import common
+import fetch
+from synd import Feed
+
+log = logging.getLogger(__name__)
+
+
+class DownloadQueue():
+    """Download jobs kept in a JSON file that is shared between processes.
+
+    A job is a dictionary of feed directory (absolute, as the queue is shared),
+    entry GUID, enclosure URL, priority, number of failed attempts, state,
+    and time of next try (seconds since the epoch). Finished jobs are removed
+    from the queue; ones that keep failing, or cannot be found, are left in
+    failed state for inspection.
+    """
+    PENDING, ACTIVE, FAILED = 'pending', 'active', 'failed'
+
+    def __init__(self, path, max_attempts=5, backoff=300):
+        self.path = Path(path)
+        self.lock_path = self.path.with_suffix('.lock')
+        self.max_attempts = max_attempts
+        self.backoff = backoff  # Delay before first retry in seconds.
+        self.lock = threading.Lock()  # Serialize threads of this process.
+
+    @contextmanager
+    def transaction(self):
+        """Lock queue file, yield list of jobs, and write it back."""
+        pyutils.files.ensure_dir(self.path)
+        with self.lock, self.lock_path.open('a') as lockfile:
+            fcntl.flock(lockfile, fcntl.LOCK_EX)
+            try:
+                jobs = common.read_data(self.path)
+            except FileNotFoundError:
+                jobs = []
+            yield jobs
+            common.write_data(self.path, jobs)
+
+    def jobs(self):
+        """Return list of jobs."""
+        with self.transaction() as jobs:
+            return list(jobs)
+
+    def enqueue(self, entries, maxsize=None):
+        """Add enclosures of entries to queue, unless already downloaded or
+        too big. Return number of jobs added.
+        """
+        encs = (x for entry in entries for x in entry.encs())
+        return self.enqueue_encs(encs, maxsize=maxsize)
+
+    def enqueue_encs(self, encs, maxsize=None):
+        """Add enclosures to queue, unless already downloaded or too big.
+        Return number of jobs added.
+        """
+        n = 0
+        with self.transaction() as jobs:
+            keys = {job_key(x): x for x in jobs}
+            for enc in encs:
+                if enc.path.exists():
+                    continue
+                if enc.is_too_big(maxsize):
+                    log.warning('Download too big: %s', enc.path)
+                    continue
+                job = new_job(enc)
+                old = keys.get(job_key(job))
+                if old is None:
+                    jobs.append(job)
+                    keys[job_key(job)] = job
+                    n += 1
+                else:
+                    old['priority'] = max(old['priority'], job['priority'])
+        return n
+
+    def is_due(self, job, now):
+        """Is job pending, and not waiting for retry?"""
+        return job['state'] == self.PENDING and (job['next_try'] is None or
+                                                 job['next_try'] <= now)
+
+    def claim(self, keys=None):
+        """Mark due jobs as active for this process, and return them in order
+        of priority. Jobs left active by dead processes are recovered. If a
+        collection of job keys is given, only those are claimed.
+        """
+        now = time.time()
+        pid = os.getpid()
+        with self.transaction() as jobs:
+            for job in jobs:
+                if job['state'] == self.ACTIVE and not pid_alive(job['pid']):
+                    log.info('Recovering job: %s', job['href'])
+                    job['state'] = self.PENDING
+            due = [x for x in jobs if self.is_due(x, now) and
+                   (keys is None or job_key(x) in keys)]
+            due.sort(key=lambda x: x['priority'], reverse=True)
+            for job in due:
+                job.update(state=self.ACTIVE, pid=pid)
+            return [dict(x) for x in due]
+
+    def complete(self, job, ok, error=None, retry=True):
+        """Remove finished job, or schedule a failed one for retry (unless
+        retrying is pointless).
+        """
+        with self.transaction() as jobs:
+            for i, old in enumerate(jobs):
+                if job_key(old) == job_key(job):
+                    break
+            else:
+                log.error('Job disappeared from queue: %s', job['href'])
+                return
+            if ok:
+                del jobs[i]
+                return
+            old['attempts'] += 1
+            old.update(pid=None, error=error)
+            if not retry or old['attempts'] >= self.max_attempts:
+                old['state'] = self.FAILED
+                log.error('Giving up after %i attempts: %s', old['attempts'],
+                          old['href'])
+            else:
+                delay = self.backoff * 2 ** (old['attempts'] - 1)
+                old['state'] = self.PENDING
+                old['next_try'] = time.time() + delay
+
+    def release(self, job):
+        """Return interrupted job to queue as it was, without counting it as
+        a failed attempt.
+        """
+        with self.transaction() as jobs:
+            for old in jobs:
+                if job_key(old) == job_key(job):
+                    old.update(state=self.PENDING, pid=None)
+                    return
+
+    def waiting_keys(self):
+        """Return set of keys of jobs waiting for retry."""
+        now = time.time()
+        return {job_key(x) for x in self.jobs() if
+                x['state'] == self.PENDING and not self.is_due(x, now)}
+
+    def pending_encs(self, feeds=None):
+        """Generate enclosures of jobs due for download."""
+        if feeds is None:
+            feeds = {}
+        now = time.time()
+        for job in self.jobs():
+            if self.is_due(job, now):
+                try:
+                    yield resolve(job, feeds)
+                except (FileNotFoundError, LookupError):
+                    pass
+
+    def drain(self, manager, keys=None):
+        """Download due jobs using a DownloadManager until none are left. If
+        a collection of job keys is given, only those are downloaded.
+        """
+        feeds = {}  # Feeds are read only once per run.
+        while True:
+            jobs = self.claim(keys=keys)
+            if not jobs:
+                break
+            futures = [self._submit(manager, x, feeds) for x in jobs]
+            wait(list(filter(None, futures)))
+
+    def _submit(self, manager, job, feeds):
+        """Submit job to manager; register completion. Return future or None.
+        """
+        try:
+            enc = resolve(job, feeds)
+        except (FileNotFoundError, LookupError) as e:
+            log.error('Cannot find job: %s: %s', job['href'], e)
+            self.complete(job, ok=False, error=f'cannot find: {e}',
+                          retry=False)
+            return None
+        future = manager.submit(enc)
+        if future is None:
+            self.complete(job, ok=enc.path.exists())
+            return None
+
+        def done(future):
+            ok = not future.cancelled() and future.result()
+            if not ok and (future.cancelled() or fetch.stopped()):
+                self.release(job)  # Interrupted, not failed.
+            else:
+                self.complete(job, ok=ok,
+                              error=None if ok else 'download failed')
+        future.add_done_callback(done)
+        return future
+
+
+def new_job(enc):
+    """Create job for enclosure."""
+    entry = enc.entry
+    return dict(feed=str(entry.feed.directory.resolve()), guid=entry.guid,
+                href=enc.href, priority=entry.score, attempts=0,
+                state=DownloadQueue.PENDING, next_try=None, pid=None,
+                error=None)
+
+
+def job_key(job):
+    """Job identity."""
+    return job['feed'], job['guid'], job['href']
+
+
+def enc_key(enc):
+    """Identity of job for enclosure."""
+    return str(enc.entry.feed.directory.resolve()), enc.entry.guid, enc.href
+
+
+def resolve(job, feeds):
+    """Find enclosure of job, using and updating a cache of read feeds."""
+    directory = Path(job['feed'])
+    if directory not in feeds:
+        feeds[directory] = Feed.read(directory)
+    for entry in feeds[directory].entries:
+        if entry.guid == job['guid']:
+            for enc in entry.encs():
+                if enc.href == job['href']:
+                    return enc
+            raise LookupError('Enclosure not in entry')
+    raise LookupError('Entry not in feed')
+
+
+def pid_alive(pid):
+    """Does process exist?"""
+    if pid is None:
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
@@ -0,0 +1,291 @@
+"""Concurrent enclosure downloads."""
+
+import logging
+import os
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from statistics import mean
+
+from boltons.strutils import bytes2human
+
+import pyutils.misc
+
+import common
+import enclosure
+import fetch
+import media
+import store
+import util
+
+log = logging.getLogger(__name__)
+messager = util.Messager(__name__)
+
+
+class DownloadManager():
+    """Download enclosures in a pool of worker threads.
+
+    Use as a context manager: enclosures are submitted while the view is being
+    walked, and leaving the context waits for all downloads to finish. On
+    interrupt, downloads are stopped and their partial files kept.
+
+    Yle downloads are slow and limited by settings, so they get a pool of
+    their own instead of holding up workers needed by other downloads.
+    """
+    def __init__(self, jobs=1, maxsize=None, interval=1):
+        self.jobs = max(1, jobs)
+        self.maxsize = maxsize  # Maximum download size in megabytes.
+        self.interval = interval  # Progress report interval in seconds.
+        self.executor = ThreadPoolExecutor(max_workers=self.jobs)
+        self.yle_executor = ThreadPoolExecutor(
+            max_workers=max(1, min(self.jobs, media.SETTINGS.yle_jobs)))
+        self.lock = threading.Lock()
+        self.futures = {}  # Destination path -> future.
+        self.hrefs = {}  # URL -> future of first download.
+        self.active = {}  # Destination path -> enclosure in progress.
+        self.nfiles = 0
+        self.ndone = 0
+        self.nfailed = 0
+        self.nbytes = 0  # Bytes in finished downloads.
+        self.start_time = None
+        self.stopped = threading.Event()
+        self.reporter = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is KeyboardInterrupt:
+            self.interrupt()
+        elif exc_type is not None:
+            self.cancel()
+        self.join()
+
+    @property
+    def quiet(self):
+        """Are per-file progress bars replaced by aggregated progress?"""
+        return self.jobs > 1
+
+    def submit(self, enc):
+        """Queue enclosure for download. Return future, or None if there is
+        nothing to do.
+        """
+        path = enc.path
+        with self.lock:
+            if path in self.futures:
+                return self.futures[path]
+            if path.exists():
+                log.debug('Already exists: %s', path)
+                return None
+            # With a store, same URL in another feed is linked, not fetched.
+            first = None
+            if store.get_store() is not None:
+                first = self.hrefs.get(enc.href)
+            executor = self.executor
+            if isinstance(enc, enclosure.YleEnclosure):
+                executor = self.yle_executor
+            future = executor.submit(self._download, enc, first)
+            self.futures[path] = future
+            self.hrefs.setdefault(enc.href, future)
+            self.nfiles += 1
+        self._start_reporter()
+        return future
+
+    def submit_entry(self, entry):
+        """Queue entry enclosures for download."""
+        return [self.submit(x) for x in entry.encs()]
+
+    def cancel(self):
+        """Cancel downloads that have not started yet."""
+        for future in self.futures.values():
+            future.cancel()
+
+    def interrupt(self):
+        """Stop running downloads, and cancel the rest."""
+        log.error('Downloads interrupted, can be resumed')
+        fetch.stop()
+        for executor in [self.executor, self.yle_executor]:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+    def join(self):
+        """Wait for all downloads to finish, and show summary."""
+        try:
+            for executor in [self.executor, self.yle_executor]:
+                executor.shutdown(wait=True)
+        except KeyboardInterrupt:
+            self.interrupt()
+            raise
+        finally:
+            self.stopped.set()
+            self._summary()
+
+    def _summary(self):
+        """Show summary, if anything was downloaded."""
+        if self.reporter is not None:
+            self.reporter.join()
+            elapsed = time.monotonic() - self.start_time
+            s = 'Downloaded {} of {} files ({}) in {:.0f} s, {} failed'
+            messager.msg(s.format(self.ndone, self.nfiles,
+                                  bytes2human(self.nbytes), elapsed,
+                                  self.nfailed))
+
+    def _download(self, enc, first=None):
+        """Download enclosure (run in worker thread), after waiting for the
+        first download of the same URL, if given.
+        """
+        if first is not None:
+            wait([first])  # Submitted earlier, so this cannot deadlock.
+        with self.lock:
+            self.active[enc.path] = enc
+        ok = False
+        try:
+            ok = common.download_enclosure(enc, maxsize=self.maxsize,
+                                           progress=not self.quiet)
+        except Exception:  # Don't let one broken server stop the others.
+            log.exception('Download failed: %s', enc.path)
+        finally:
+            with self.lock:
+                del self.active[enc.path]
+                if ok:
+                    self.ndone += 1
+                    self.nbytes += _bytes_on_disk(enc)
+                else:
+                    self.nfailed += 1
+        if ok:
+            print(pyutils.misc.ring_bell(), flush=True)
+        return ok
+
+    def _start_reporter(self):
+        """Start progress reporter thread, if needed and not running yet."""
+        with self.lock:
+            if self.reporter is not None:
+                return
+            self.start_time = time.monotonic()
+            self.reporter = threading.Thread(target=self._report, daemon=True)
+        self.reporter.start()
+
+    def _report(self):
+        """Show aggregated progress periodically until stopped."""
+        while not self.stopped.wait(self.interval):
+            if self.quiet:
+                messager.msg(self.progress(), end='\r', flush=True,
+                             truncate=True)
+
+    def progress(self):
+        """Return aggregated progress as a string."""
+        with self.lock:
+            active = list(self.active.values())
+            nbytes = self.nbytes
+            d = dict(done=self.ndone + self.nfailed, n=self.nfiles,
+                     active=len(active))
+        nbytes += sum(_bytes_on_disk(x) for x in active)
+        elapsed = time.monotonic() - self.start_time
+        d.update(nbytes=bytes2human(nbytes),
+                 rate=bytes2human(nbytes / max(elapsed, 1)))
+        return '[{done}/{n}] {nbytes}, {rate}/s, {active} active'.format(**d)
+
+
+def _bytes_on_disk(enc):
+    """Return number of bytes written so far for enclosure."""
+    nbytes = fetch.transferred(enc.path)
+    if nbytes is not None:
+        return nbytes
+    info = media.progress(enc.path)
+    if info is not None:
+        return info.get('bytes', 0)
+    for path in [enc.path, fetch.part_path(enc.path)]:
+        try:
+            return path.stat().st_size
+        except FileNotFoundError:
+            pass
+    return 0
+
+
+class Plan():
+    """Download plan: enclosures chosen to fit in disk budget and free space.
+
+    Items are (enclosure, bytes needed, whether size is a guess) tuples.
+    """
+    def __init__(self, budget=None, reserve=0):
+        self.budget = budget  # Maximum bytes to download, or None.
+        self.reserve = reserve  # Free space to leave on each disk, in bytes.
+        self.selected = []
+        self.skipped = []
+        self.free = {}  # Device -> bytes available for downloads.
+        self.total = 0  # Bytes needed by selected items.
+
+    def nbytes(self, items=None):
+        """Total bytes needed by items (by default, the selected ones)."""
+        if items is None:
+            items = self.selected
+        return sum(x[1] for x in items)
+
+    def available(self, directory):
+        """Return free space on disk of directory, minus what is planned."""
+        dev = os.stat(directory).st_dev
+        if dev not in self.free:
+            usage = shutil.disk_usage(directory)
+            self.free[dev] = usage.free - self.reserve
+        return dev, self.free[dev]
+
+    def consider(self, enc, nbytes, guess):
+        """Select enclosure if it fits, otherwise skip it."""
+        item = (enc, nbytes, guess)
+        dev, free = self.available(enc.entry.feed.directory)
+        fits = nbytes <= free
+        if self.budget is not None:
+            fits = fits and self.total + nbytes <= self.budget
+        if fits:
+            self.selected.append(item)
+            self.total += nbytes
+            self.free[dev] -= nbytes
+        else:
+            self.skipped.append(item)
+
+    def show(self, verbose=False):
+        """Print plan."""
+        def row(mark, item):
+            enc, nbytes, guess = item
+            size = bytes2human(nbytes) + ('?' if guess else '')
+            return [mark, size, enc.entry.score, enc.entry.feed.directory,
+                    enc.filename]
+        rows = [row('+', x) for x in self.selected]
+        if verbose:
+            rows.extend(row('-', x) for x in self.skipped)
+        if rows:
+            messager.msg(util.fmt_table(rows))
+        s = 'Plan: {} files ({}), skipped {} ({})'
+        messager.msg(s.format(len(self.selected), bytes2human(self.nbytes()),
+                              len(self.skipped),
+                              bytes2human(self.nbytes(self.skipped))))
+
+
+def plan_downloads(encs, budget=None, reserve=0, jobs=1):
+    """Choose enclosures to download in order of entry score, so that they fit
+    in disk budget and free space. Missing lengths are probed concurrently
+    with HEAD requests, and the rest are guessed. Return Plan.
+    """
+    encs = list({x.path: x for x in encs if not x.path.exists()}.values())
+    missing = [x for x in encs if not x.length]
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        probed = dict(zip(missing, executor.map(lambda x: x.probe_length(),
+                                                missing)))
+    lengths = [x.length or probed.get(x) for x in encs]
+    known = [x for x in lengths if x]
+    default = int(mean(known)) if known else 0
+    plan = Plan(budget=budget, reserve=reserve)
+    items = sorted(zip(encs, lengths), key=lambda x: x[0].entry.score,
+                   reverse=True)
+    for enc, length in items:
+        nbytes = (length or default) - _partial_bytes(enc)
+        plan.consider(enc, max(0, nbytes), guess=not length)
+    return plan
+
+
+def _partial_bytes(enc):
+    """Return size of partial download file for enclosure."""
+    try:
+        return fetch.part_path(enc.path).stat().st_size
+    except FileNotFoundError:
+        return 0
@@ -8,7 +8,10 @@ from jupitotools.media.ylemedia import YleMedia
 import pyutils.files
 import pyutils.net
 
+import dirstate
+import fetch
 import media
+import progressive
 import util
 
 log = logging.getLogger(__name__)
@@ -77,48 +80,80 @@ class Enclosure():
         """Size on disk."""
         return self.path.stat().st_size
 
+    def status(self):
+        """Return cached dirstate.FileStatus of file, or None if missing."""
+        return dirstate.status(self.path)
+
     def is_too_big(self, maxsize):
         """Is it too big to download? Maximum size is given in megabytes."""
         return maxsize is not None and (self.length or 0) > maxsize * 1024**2
 
+    def probe_length(self):
+        """Ask server for file length. Return None if unknown."""
+        return fetch.probe_length(self.href)
+
     def duration(self):
         """Media duration."""
         return media.get_duration(self.path)
 
     def is_normalized(self):
-        """Has loudness been normalized?"""
-        return media.get_gain(self.path) is not None
+        """Has loudness been normalized? (Cached, see `status()`.)"""
+        status = self.status()
+        return status is not None and status.gain is not None
 
-    def download(self):
-        """Download file."""
+    def download(self, progress=True):
+        """Download file. Loudness is analyzed on the way, if enabled."""
         # log.info('Downloading: %s', self.path)
         pyutils.files.ensure_dir(self.path)
-        return pyutils.net.download(self.href, self.path, progress=True)
+        analyzer = None
+        if media.SETTINGS.inline_loudness:
+            analyzer = media.LoudnessAnalyzer()
+        ok = False
+        try:
+            ok = fetch.download(self.href, self.path, length=self.length,
+                                progress=progress, sink=analyzer)
+        finally:
+            if analyzer is not None:
+                if ok:
+                    analyzer.finish(self.path)
+                else:
+                    analyzer.abort()
+            dirstate.invalidate(self.path)
+        return ok
+
+    def start_position(self):
+        """Return playback start position as a fraction, or None."""
+        if self.entry.progress is not None and 0 < self.entry.progress < 1:
+            return float(self.entry.progress)
+        return None
 
     def play(self):
         """Play downloaded file."""
-        if self.entry.progress is not None and 0 < self.entry.progress < 1:
-            start = float(self.entry.progress)
-        else:
-            start = None
-        return media.play_file(self.path, start=start)
+        return media.play_file(self.path, start=self.start_position())
 
     def stream(self):
         """Stream from net."""
         return media.play_stream(self.href)
 
+    def play_progressive(self):
+        """Play from net while downloading, without fetching anything twice."""
+        pyutils.files.ensure_dir(self.path)
+        return progressive.play(self, start=self.start_position())
+
     def remove(self):
         """Remove from disk."""
         if self.path.exists():
             # self.path.unlink()
             pyutils.files.trash_or_rm(self.path)
+            dirstate.invalidate(self.path)
         for path in self.path.parent.glob(f'{self.path.stem}.*.srt'):
             logging.warning('Removing subtitle: %s', path)
 
     def score(self):
         """Enclosure score."""
-        if self.path.exists():
-            if self.is_normalized():
+        status = self.status()
+        if status is not None:
+            if status.gain is not None:
                 return 2
             return 1
         return 0
@@ -136,14 +171,20 @@ class YleEnclosure(Enclosure):
     def suffix(self):
         return '.flv'
 
-    def download(self):
+    def download(self, progress=True):
         pyutils.files.ensure_dir(self.path)
         return media.download_yle(self.href, self.path, sublang=self.sublang(),
-                                  verbose=True)
+                                  verbose=progress, stop=fetch.stopped)
 
     def stream(self):
         return media.stream(self.href)
 
+    def play_progressive(self):
+        raise NotImplementedError()
+
+    def probe_length(self):
+        return None
+
     def sublang(self):
         """Return subtitle language."""
         return self.entry.get_tags().get('sub')
@@ -162,8 +203,14 @@ class YoutubeEnclosure(Enclosure):
     def suffix(self):
         return '.flv'
 
-    def download(self):
+    def download(self, progress=True):
         raise NotImplementedError()
 
+    def probe_length(self):
+        return None
+
     def play(self):
         raise NotImplementedError()
+
+    def play_progressive(self):
+        raise NotImplementedError()
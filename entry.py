@@ -1,8 +1,9 @@
 """Feed entry."""
 
+import datetime
 import logging
 import webbrowser
-from functools import lru_cache, total_ordering
+from functools import total_ordering
 
 from boltons.strutils import html2text
 from pyutils.misc import int_or_float
@@ -18,6 +19,11 @@ messager = util.Messager(__name__)
 @total_ordering
 class Entry():
     """Feed entry."""
+    flag_listeners = []  # Called with (entry, old flag) on flag change.
+    # Cached values and the attributes they are derived from.
+    DEPENDENCIES = dict(tags={'tags', 'feed'}, enc={'enclosures', 'link'},
+                        text={'feed', 'title', 'subtitle', 'summary'})
+
     def __init__(self, feed, guid, link, date_published, date_seen, author,
                  title, subtitle, summary, enclosures, tags, flag=Flag.fresh,
                  progress=0):
@@ -35,6 +41,7 @@ class Entry():
         self.tags = tags
         self.flag = Flag(flag)
         self.progress = progress
+        self._derived = util.DerivedValues(self.DEPENDENCIES)
 
     def __str__(self):
         return self.title or self.link or self.guid
@@ -42,10 +49,17 @@ class Entry():
     def __lt__(self, other):
         return self.date < other.date
 
+    def __setattr__(self, name, value):
+        super().__setattr__(name, value)
+        derived = self.__dict__.get('_derived')
+        if derived is not None:
+            derived.invalidate(name)
+
     def as_json(self):
         """Serialize as JSON."""
         d = dict(self.__dict__)
         del d['feed']
+        del d['_derived']
         d['progress'] = d.pop('_progress')
         return d
 
@@ -79,21 +93,43 @@ class Entry():
         #     return self.enc.score() if self.enclosures else 0
         return self.feed.priority * 10 + self.flag.score()  # + enc_score(self)
 
-    @lru_cache()
     def get_tags(self):
         """Get entry tags (including feed tags)."""
-        tags = TagDict()
-        for s in self.tags:
-            tags.parse(s)
-        tags.update(self.feed.get_tags())  # Feed tags override entry tags.
-        return tags
+        feed_tags = self.feed.get_tags()
+
+        def get():
+            tags = TagDict()
+            for s in self.tags:
+                tags.parse(s)
+            tags.update(feed_tags)  # Feed tags override entry tags.
+            return tags
+        # Cheap while feed tags stay the same object (tuples compare items
+        # by identity first).
+        return self._derived.get('tags', get, stamp=(feed_tags,))
+
+    def search_text(self):
+        """Return feed and entry text for searching, stripped of HTML and
+        folded (see `util.fold_text()`), one field per line.
+        """
+        head = self.feed.head
+        strings = (str(self.feed.directory), head.title, head.subtitle,
+                   head.summary, self.title, self.subtitle, self.summary)
+
+        def get():
+            return util.fold_text('\n'.join(html2text(x) for x in strings
+                                            if x))
+        # The source fields are the stamp, so changes in the feed header or
+        # in place are noticed, too.
+        return self._derived.get('text', get, stamp=strings)
 
     def set_flag(self, value):
         """Set flag."""
         flag = Flag(value)
         if self.flag != flag:
-            self.flag = flag
+            old, self.flag = self.flag, flag
             self.feed.modified = True
+            for listener in self.flag_listeners:
+                listener(self, old)
 
     @property
     def status(self):
@@ -113,6 +149,7 @@ class Entry():
     def progress(self, value):
         self._progress = int_or_float(value)
         self.feed.modified = True
+        self.feed.invalidate('entries')
 
     def skipped(self):
         """Was entry skipped without listening?"""
@@ -170,19 +207,36 @@ class Entry():
             yield YoutubeEnclosure(self)
 
     @property
-    @lru_cache()
     def enc(self):
         """Shorcut."""
-        lst = list(self.encs())
-        if lst:
-            return lst[0]
-        raise FileNotFoundError(f'No enclosures: {self}')
+        enc = self._derived.get('enc', lambda: next(self.encs(), None))
+        if enc is None:
+            raise FileNotFoundError(f'No enclosures: {self}')
+        return enc
+
+    def derived(self, name, func):
+        """Return value computed from enclosure files by func(), cached until
+        the files change. Downloading, removing, and normalizing files show in
+        their cached status (see dirstate), which invalidates the value.
+        """
+        stamp = tuple(x.status() for x in self.encs())
+        return self._derived.get(name, func, stamp=stamp)
 
     def duration(self):
-        return sum((x.duration() or 0) for x in self.enclosures)
+        """Total duration of downloaded enclosures, or None."""
+        def compute():
+            durations = [x.duration() for x in self.encs() if
+                         x.status() is not None]
+            durations = [x for x in durations if x is not None]
+            if not durations:
+                return None
+            return sum(durations, datetime.timedelta())
+        return self.derived('duration', compute)
 
     def size(self):
-        return sum((x.size() or 0) for x in self.enclosures)
+        """Total size of downloaded enclosures."""
+        return sum(x.size for x in (y.status() for y in self.encs()) if
+                   x is not None)
 
     def open_link(self):
         """Open entry link in web browser."""
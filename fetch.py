@@ -0,0 +1,441 @@
+"""HTTP file transfer with resumable partial downloads."""
+
+import json
+import logging
+import os
+import re
+import sys
+import threading
+import urllib.parse
+import urllib.request
+from contextlib import contextmanager
+from http import HTTPStatus
+from http.client import HTTPException, IncompleteRead
+from urllib.error import HTTPError
+
+from boltons.strutils import bytes2human
+
+import throttle
+import util
+
+log = logging.getLogger(__name__)
+
+CHUNK_SIZE = 64 * 1024
+TIMEOUT = 60  # Socket timeout in seconds.
+HEADERS = {'User-Agent': 'podxm'}
+SETTINGS = util.AttrDict(
+    segments=1,  # Maximum number of segments per file; 1 disables segmenting.
+    segment_threshold=100 * 1024**2,  # Minimum file size to segment (bytes).
+    segments_per_host=4,  # Maximum concurrent segment connections per host.
+    probe_ranges=False,  # Probe range support if Accept-Ranges is missing.
+    )
+
+_transferred = {}  # Destination path -> bytes transferred so far.
+_active = {}  # Destination path -> [done event, result] of download.
+_active_lock = threading.Lock()
+_stop = threading.Event()  # Set to stop all downloads, see stop().
+_host_slots = {}  # Host name -> semaphore.
+_host_slots_lock = threading.Lock()
+
+
+def configure(**kwargs):
+    """Update settings."""
+    SETTINGS.update(kwargs)
+
+
+def stop():
+    """Stop all downloads in progress, keeping partial files for resuming.
+    Used on interrupt, when downloads run in worker threads.
+    """
+    _stop.set()
+
+
+def stopped():
+    """Have downloads been stopped?"""
+    return _stop.is_set()
+
+
+def part_path(path):
+    """Return path of partial download file."""
+    return path.with_name(path.name + '.part')
+
+
+def meta_path(path):
+    """Return path of partial download metadata file."""
+    return path.with_name(path.name + '.part.json')
+
+
+def read_meta(path):
+    """Read partial download metadata, or empty dictionary."""
+    try:
+        with meta_path(path).open() as fp:
+            return json.load(fp)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def write_meta(path, meta):
+    """Write partial download metadata."""
+    with meta_path(path).open('w') as fp:
+        json.dump(meta, fp)
+
+
+def request(url, method='GET', headers=None):
+    """Open URL, return response."""
+    headers = dict(HEADERS, **(headers or {}))
+    req = urllib.request.Request(url, headers=headers, method=method)
+    return urllib.request.urlopen(req, timeout=TIMEOUT)
+
+
+def content_range(response):
+    """Parse Content-Range header into (start, total). Total may be None."""
+    m = re.match(r'bytes (\d+)-\d+/(\d+|\*)',
+                 response.headers.get('Content-Range', ''))
+    if m is None:
+        return None, None
+    start, total = m.groups()
+    return int(start), None if total == '*' else int(total)
+
+
+def content_length(response):
+    """Return Content-Length header as integer, or None."""
+    value = response.headers.get('Content-Length', '')
+    return int(value) if value.isdigit() else None
+
+
+def probe_length(url):
+    """Return file length from a HEAD request, or None if unknown."""
+    try:
+        with request(url, method='HEAD') as response:
+            return content_length(response)
+    except OSError as e:
+        log.debug('Cannot probe: %s: %s', url, e)
+        return None
+
+
+def open_resumed(url, path, offset, meta):
+    """Request rest of file from offset. Return (response, offset, total),
+    where offset is zero if the server sends the whole file anew.
+    """
+    headers = {}
+    if offset:
+        headers['Range'] = f'bytes={offset}-'
+        validator = meta.get('etag') or meta.get('modified')
+        if validator:
+            headers['If-Range'] = validator
+    try:
+        response = request(url, headers=headers)
+    except HTTPError as e:
+        if e.code != HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE or not offset:
+            raise
+        log.warning('Cannot resume, restarting: %s', path)
+        return open_resumed(url, path, 0, meta)
+    if response.status == HTTPStatus.PARTIAL_CONTENT:
+        start, total = content_range(response)
+        if start == offset and total == meta.get('length', total):
+            log.info('Resuming at %s: %s', bytes2human(offset), path)
+            return response, offset, total
+        # Something changed on the server, or we got confused.
+        response.close()
+        log.warning('Cannot resume, restarting: %s', path)
+        return open_resumed(url, path, 0, meta)
+    return response, 0, content_length(response)
+
+
+def download(url, path, length=None, progress=False, segmented=True,
+             sink=None):
+    """Download URL to path via a partial file, resuming an earlier attempt if
+    possible. Return True if successful.
+
+    If a sink is given, the whole content is also passed to its `write()`
+    method in order, which requires downloading as a single stream.
+
+    Large files are fetched in several segments in parallel, if allowed,
+    enabled in settings, and supported by the server. The partial file is
+    validated against the total length reported by the server, if any,
+    before it is moved into place.
+
+    Only one download to a path runs at a time in this process. Later
+    callers wait for it and share its result, instead of writing to the same
+    partial file.
+    """
+    with _active_lock:
+        waiter = _active.get(path)
+        if waiter is None:
+            waiter = _active[path] = [threading.Event(), False]
+            running = False
+        else:
+            running = True
+    if running:
+        log.info('Waiting for download in progress: %s', path)
+        waiter[0].wait()
+        if waiter[1]:
+            feed_sink(sink, path, path.stat().st_size)
+        return waiter[1]
+    try:
+        waiter[1] = _download(url, path, length, progress, segmented, sink)
+        return waiter[1]
+    finally:
+        with _active_lock:
+            del _active[path]
+        _transferred.pop(path, None)
+        waiter[0].set()
+
+
+def _download(url, path, length, progress, segmented, sink):
+    meta = read_meta(path)
+    if meta.get('url') != url:
+        meta = {}  # Stale leftovers from some other download.
+    if segmented and sink is None and SETTINGS.segments > 1:
+        if not meta.get('segments'):
+            meta = plan_segments(url, path, meta) or meta
+        if meta.get('segments'):
+            return download_segmented(url, path, meta, length, progress)
+    elif meta.get('segments'):
+        meta = {}  # Segmented partial file has holes, cannot append.
+    return download_stream(url, path, meta, length, progress, sink)
+
+
+def transferred(path):
+    """Return number of bytes transferred so far in an ongoing download to
+    path, or None if there is no such download.
+    """
+    return _transferred.get(path)
+
+
+def download_stream(url, path, meta, length, progress, sink=None):
+    """Download as a single stream, appending to partial file if possible."""
+    part = part_path(path)
+    offset = part.stat().st_size if meta and part.exists() else 0
+    if offset and offset == meta.get('length'):
+        feed_sink(sink, part, offset)
+        return finish(path, offset, length)  # Interrupted before rename.
+    try:
+        response, offset, total = open_resumed(url, path, offset, meta)
+    except OSError as e:
+        log.error('Error connecting: %s: %s', url, e)
+        return False
+    feed_sink(sink, part, offset)
+    meta = dict(url=url, etag=response.headers.get('ETag'),
+                modified=response.headers.get('Last-Modified'),
+                length=total)
+    write_meta(path, meta)
+    nbytes = offset
+    with response, part.open('ab' if offset else 'wb') as fp:
+        try:
+            while True:
+                if _stop.is_set():
+                    log.warning('Download stopped, partial file kept: %s',
+                                path)
+                    return False
+                chunk = response.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                throttle.consume(len(chunk))
+                fp.write(chunk)
+                if sink is not None:
+                    sink.write(chunk)
+                nbytes += len(chunk)
+                _transferred[path] = nbytes
+                if progress:
+                    show_progress(nbytes, total or length)
+        except (OSError, HTTPException) as e:
+            log.error('Download interrupted, partial file kept: %s: %s', path,
+                      e)
+            return False
+        finally:
+            if progress:
+                print(file=sys.stderr)
+    return finish(path, total, length)
+
+
+def feed_sink(sink, part, offset):
+    """Pass data already in (partial) file to sink, when resuming."""
+    if sink is None or not offset:
+        return
+    with part.open('rb') as fp:
+        while offset > 0:
+            chunk = fp.read(min(CHUNK_SIZE, offset))
+            if not chunk:
+                break
+            sink.write(chunk)
+            offset -= len(chunk)
+
+
+def plan_segments(url, path, meta):
+    """Return metadata for a segmented download, or None if the file is too
+    small or the server does not support range requests.
+    """
+    try:
+        with request(url, method='HEAD') as response:
+            headers = response.headers
+            total = content_length(response)
+    except OSError as e:
+        log.debug('Cannot probe, using single stream: %s: %s', url, e)
+        return None
+    if total is None or total < SETTINGS.segment_threshold:
+        return None
+    if headers.get('Accept-Ranges', '').lower() != 'bytes':
+        if not SETTINGS.probe_ranges:
+            log.debug('No Accept-Ranges, using single stream: %s', url)
+            return None
+        try:
+            with request(url, headers={'Range': 'bytes=0-0'}) as response:
+                ok = (response.status == HTTPStatus.PARTIAL_CONTENT and
+                      content_range(response) == (0, total))
+        except OSError:
+            ok = False
+        if not ok:
+            log.debug('Range probe failed, using single stream: %s', url)
+            return None
+    # Continue where a single stream left off, if it is the same file.
+    part = part_path(path)
+    start = 0
+    if meta.get('length') == total and part.exists():
+        start = part.stat().st_size
+    return dict(url=url, etag=headers.get('ETag'),
+                modified=headers.get('Last-Modified'), length=total,
+                segments=split_range(start, total, SETTINGS.segments))
+
+
+def split_range(start, stop, n):
+    """Split byte range into at most n segments of [position, last byte]."""
+    size = max(1, -(-(stop - start) // n))
+    return [[x, min(x + size, stop) - 1] for x in range(start, stop, size)]
+
+
+def download_segmented(url, path, meta, length, progress):
+    """Download segments in parallel into a preallocated partial file."""
+    part = part_path(path)
+    total = meta['length']
+    segments = [x for x in meta['segments'] if x[0] <= x[1]]
+    log.info('Downloading in %i segments: %s', len(segments), path)
+    lock = threading.Lock()
+    stop = threading.Event()
+    errors = []
+    fd = os.open(part, os.O_RDWR | os.O_CREAT)
+    try:
+        preallocate(fd, total)
+    finally:
+        os.close(fd)
+    threads = [threading.Thread(target=_fetch_segment, daemon=True,
+                                args=(url, part, x, meta, lock, stop, errors))
+               for x in segments]
+    try:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            while thread.is_alive():
+                thread.join(timeout=1)
+                with lock:
+                    write_meta(path, meta)
+                    nbytes = total - sum(x[1] - x[0] + 1 for x in segments)
+                _transferred[path] = nbytes
+                if progress:
+                    show_progress(nbytes, total)
+    finally:
+        stop.set()
+        with lock:
+            write_meta(path, meta)
+        if progress:
+            print(file=sys.stderr)
+    if any(isinstance(x, RangeError) for x in errors):
+        log.warning('File changed on server, starting over: %s', path)
+        part.unlink()
+        meta_path(path).unlink()
+        return False
+    if errors:
+        log.error('Download interrupted, partial file kept: %s: %s', path,
+                  errors[0])
+        return False
+    if _stop.is_set():
+        log.warning('Download stopped, partial file kept: %s', path)
+        return False
+    return finish(path, total, length)
+
+
+class RangeError(Exception):
+    """Server did not honour range request."""
+
+
+def _fetch_segment(url, part, segment, meta, lock, stop, errors):
+    """Fetch segment into partial file, advancing its position as data is
+    written (run in thread). Errors are collected in list.
+    """
+    headers = {'Range': 'bytes={}-{}'.format(*segment)}
+    validator = meta.get('etag') or meta.get('modified')
+    if validator:
+        headers['If-Range'] = validator
+    try:
+        with host_slot(url), request(url, headers=headers) as response, \
+                part.open('r+b', buffering=0) as fp:
+            if (response.status != HTTPStatus.PARTIAL_CONTENT or
+                    content_range(response)[0] != segment[0]):
+                raise RangeError(url)
+            while (segment[0] <= segment[1] and not stop.is_set() and
+                   not _stop.is_set()):
+                n = min(CHUNK_SIZE, segment[1] - segment[0] + 1)
+                chunk = response.read(n)
+                if not chunk:
+                    raise IncompleteRead(b'', n)
+                throttle.consume(len(chunk))
+                fp.seek(segment[0])
+                fp.write(chunk)
+                with lock:
+                    segment[0] += len(chunk)
+    except (OSError, HTTPException, RangeError) as e:
+        errors.append(e)
+        stop.set()
+
+
+@contextmanager
+def host_slot(url):
+    """Context manager limiting concurrent segment connections per host."""
+    host = urllib.parse.urlsplit(url).hostname
+    with _host_slots_lock:
+        slot = _host_slots.get(host)
+        if slot is None:
+            slot = threading.BoundedSemaphore(SETTINGS.segments_per_host)
+            _host_slots[host] = slot
+    with slot:
+        yield
+
+
+def preallocate(fd, size):
+    """Set file size, reserving disk space if possible."""
+    if os.fstat(fd).st_size != size:
+        os.ftruncate(fd, size)
+        try:
+            os.posix_fallocate(fd, 0, size)
+        except (AttributeError, OSError):
+            pass  # Not supported by platform or filesystem.
+
+
+def finish(path, total, length):
+    """Validate partial file size against total length reported by the
+    server, and move it into place. Advertised lengths from feeds are often
+    wrong, so a mismatch with one is only reported.
+    """
+    part = part_path(path)
+    size = part.stat().st_size
+    if total is not None and size != total:
+        log.error('Size mismatch, partial file kept: %i != %i: %s', size,
+                  total, path)
+        return False
+    if length and size != length:
+        level = logging.WARNING if total is None else logging.DEBUG
+        log.log(level, 'Advertised length %i differs from real %i: %s',
+                length, size, path)
+    os.replace(part, path)
+    meta_path(path).unlink()
+    return True
+
+
+def show_progress(nbytes, total):
+    """Show progress line for a single download."""
+    if total:
+        s = '{} / {} ({:.0%})'.format(bytes2human(nbytes), bytes2human(total),
+                                      nbytes / total)
+    else:
+        s = bytes2human(nbytes)
+    print(f'\r{s}   ', end='', file=sys.stderr, flush=True)
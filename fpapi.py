@@ -7,6 +7,8 @@ import logging
 
 import feedparser
 
+import throttle
+
 log = logging.getLogger(__name__)
 
 
@@ -126,4 +128,5 @@ def get_entry(fp, feed):
 
 def parse(url, etag=None, modified=None):
     """Fetch and parse a feed file."""
-    return feedparser.parse(url, etag=etag, modified=modified)
+    return feedparser.parse(url, etag=etag, modified=modified,
+                            handlers=[throttle.ThrottleHandler()])
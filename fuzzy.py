@@ -0,0 +1,82 @@
+"""Ranked fuzzy search of entries by n-grams of words."""
+
+import logging
+import re
+from array import array
+from collections import Counter, defaultdict
+
+import util
+
+log = logging.getLogger(__name__)
+
+N = 3  # Length of n-grams.
+MIN_SIMILARITY = 0.5  # Share of query n-grams that must be found.
+SIMILARITY_WEIGHT = 100  # Similarity 0.1 weighs as much as one priority step.
+WORD_RE = re.compile(r'[^\W_]+')
+
+
+def ngrams(text, n=N):
+    """Return set of n-grams of folded words in text. Words are padded with
+    spaces, so that word beginnings and ends, and short words, count.
+    """
+    grams = set()
+    for word in set(WORD_RE.findall(util.fold_text(text))):
+        word = f' {word} '
+        grams.update([word[i:i+n] for i in
+                      range(max(1, len(word) - n + 1))])
+    return grams
+
+
+def feed_text(feed):
+    """Return feed text to match against: feed title and tags."""
+    return ' '.join([feed.head.title or '', *feed.get_tags().as_strings()])
+
+
+def entry_text(entry):
+    """Return entry text to match against: title and own tags."""
+    return ' '.join([entry.title or '', *entry.tags])
+
+
+class FuzzyIndex():
+    """Index from n-grams to entries, for finding entries that share most
+    n-grams with a query. Postings are compact arrays of entry numbers.
+    """
+    def __init__(self, entries):
+        self.entries = list(entries)
+        postings = defaultdict(lambda: array('I'))
+        feed_grams = {}  # Feed -> n-grams, shared by its entries.
+        for i, entry in enumerate(self.entries):
+            feed = entry.feed
+            if feed not in feed_grams:
+                feed_grams[feed] = ngrams(feed_text(feed))
+            for gram in ngrams(entry_text(entry)) | feed_grams[feed]:
+                postings[gram].append(i)
+        self.postings = dict(postings)
+        log.debug('Indexed %i entries by %i n-grams', len(self.entries),
+                  len(self.postings))
+
+    def __len__(self):
+        return len(self.entries)
+
+    def search(self, text, limit=None, min_similarity=MIN_SIMILARITY):
+        """Return list of (score, entry index), best first. Score is the
+        share of n-grams of text found in entry, weighted, plus entry score.
+        A limit of None or -1 (like any negative) means no limit.
+        """
+        grams = ngrams(text)
+        if not grams:
+            return []
+        counts = Counter()
+        for gram in grams:
+            counts.update(self.postings.get(gram, ()))
+        need = min_similarity * len(grams)
+        results = []
+        for i, n in counts.items():
+            if n >= need:
+                similarity = n / len(grams)
+                score = similarity * SIMILARITY_WEIGHT + self.entries[i].score
+                results.append((score, i))
+        results.sort(key=lambda x: x[0], reverse=True)
+        if limit is None or limit < 0:
+            return results
+        return results[:limit]
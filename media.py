@@ -1,23 +1,47 @@
 """Media files."""
 
+import atexit
 import datetime
+import fcntl
 import json
 import logging
+import os
+import re
 import shlex
+import signal
 import subprocess
+import sys
 import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
 from pathlib import Path
 
 from misctypes import Gain
 from pyutils.files import XAttrStr, move
 from pyutils.misc import fmt_args
 
+import util
+
 log = logging.getLogger(__name__)
 
+SETTINGS = util.AttrDict(
+    yle_jobs=2,  # Maximum number of concurrent Yle downloads per manager.
+    yle_timeout=None,  # Yle download timeout in seconds.
+    probe_cache=None,  # Media info cache file.
+    inline_loudness=False,  # Analyze loudness while downloading.
+    )
+
+GAIN_KEY = 'user.loudness.replaygain_track_gain'  # ReplayGain xattr.
+
+_progress = {}  # Destination path -> progress info of Yle download.
+_probe_cache = None
+
 
-def call(args):
+def call(args, **kwargs):
     log.info('Running: %s', ' '.join(args))
-    return subprocess.call(args)
+    return subprocess.call(args, **kwargs)
 
 
 def check_output(args, **kwargs):
@@ -33,19 +57,116 @@ def check_output(args, **kwargs):
         return None
 
 
+def configure(**kwargs):
+    """Update settings."""
+    global _probe_cache
+    SETTINGS.update(kwargs)
+    if 'probe_cache' in kwargs:
+        if _probe_cache is not None:
+            _probe_cache.write()
+        _probe_cache = None
+        if SETTINGS.probe_cache is not None:
+            _probe_cache = ProbeCache(SETTINGS.probe_cache)
+
+
+def run_monitored(args, cwd=None, timeout=None, callback=None, stop=None,
+                  interval=0.5):
+    """Run command, passing output lines to callback as they come, and killing
+    it after timeout seconds, or when stop() returns true (checked every
+    interval seconds). Return exit code (None if not run to completion) and
+    output.
+    """
+    log.info('Running: %s', ' '.join(args))
+    try:
+        proc = subprocess.Popen(args, cwd=cwd, stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT,
+                                start_new_session=True)
+    except FileNotFoundError:
+        log.error('Command not found: %s', args[0])
+        return None, ''
+    lines = []
+
+    def read_output():
+        """Split output by newlines and carriage returns (progress)."""
+        buf = b''
+        for chunk in iter(lambda: proc.stdout.read1(4096), b''):
+            *parts, buf = re.split(rb'[\r\n]', buf + chunk)
+            for line in filter(None, parts):
+                handle_line(line)
+        if buf:
+            handle_line(buf)
+
+    def handle_line(line):
+        line = line.decode(errors='replace')
+        lines.append(line)
+        if callback is not None:
+            callback(line)
+
+    reader = threading.Thread(target=read_output, daemon=True)
+    reader.start()
+    # The command runs in its own session, so interrupts must be passed on.
+    deadline = None if timeout is None else time.monotonic() + timeout
+    returncode = None
+    try:
+        while returncode is None:
+            try:
+                returncode = proc.wait(timeout=interval)
+            except subprocess.TimeoutExpired:
+                if stop is not None and stop():
+                    log.error('Stopped: %s', ' '.join(args))
+                    break
+                if deadline is not None and time.monotonic() > deadline:
+                    log.error('Timeout after %s s: %s', timeout,
+                              ' '.join(args))
+                    break
+    finally:
+        if proc.poll() is None:
+            os.killpg(proc.pid, signal.SIGKILL)
+            proc.wait()
+        reader.join()
+    return returncode, '\n'.join(lines)
+
+
+def parse_progress(line):
+    """Parse progress info from yle-dl (or ffmpeg) output line. Return
+    dictionary with any of bytes, seconds, and percent.
+    """
+    d = {}
+    m = re.search(r'size=\s*(\d+)\s*[kK]i?B', line)
+    if m:
+        d['bytes'] = int(m.group(1)) * 1024
+    m = re.search(r'time=\s*(\d+):(\d+):(\d+(?:\.\d+)?)', line)
+    if m:
+        h, mi, sec = m.groups()
+        d['seconds'] = int(h) * 3600 + int(mi) * 60 + float(sec)
+    m = re.search(r'(\d+(?:\.\d+)?)\s*%', line)
+    if m:
+        d['percent'] = float(m.group(1))
+    return d
+
+
+def progress(path):
+    """Return progress info of ongoing Yle download to path, or None."""
+    return _progress.get(path)
+
+
 def download_yle(url, path, sublang=None, tmpdir=None, verbose=True,
                  # backend='youtubedl,rtmpdump'
-                 backend='wget,ffmpeg'):
+                 backend='wget,ffmpeg', stop=None):
     """Download file from Yle Areena. Return True if succesful.
 
     `sublang` can be fin, swe, smi, none or all. TODO: changed???
+    The download is killed when `stop()` returns true, see `run_monitored`.
+
+    Each download runs in its own temporary directory. Concurrency is limited
+    by the caller, see `download.DownloadManager`.
     """
     if tmpdir is None:
         with tempfile.TemporaryDirectory(suffix='.tmp', prefix='yledl-') as t:
-            return download_yle(url, path, sublang=sublang, tmpdir=Path(t))
+            return download_yle(url, path, sublang=sublang, tmpdir=Path(t),
+                                verbose=verbose, backend=backend,
+                                stop=stop)
 
-    if verbose:
-        print(f'Downloading: {path}')
     if sublang is None:
         sublang = 'all'
     # path = Path(path)
@@ -57,8 +178,29 @@ def download_yle(url, path, sublang=None, tmpdir=None, verbose=True,
     d = dict(be=backend, sublang=sublang, o=stream.name, url=url)
     args = fmt_args(s, **d)
     logging.debug(args)
-    output = check_output(args, stderr=subprocess.STDOUT, cwd=tmpdir)
-    if output is None:
+
+    def show_progress(line):
+        """Record progress, and show it if verbose."""
+        info = parse_progress(line)
+        if info:
+            _progress[path] = dict(_progress.get(path, {}), **info)
+            if verbose:
+                print(f'\r{line[:79]}', end='', file=sys.stderr, flush=True)
+
+    if verbose:
+        print(f'Downloading: {path}')
+    try:
+        returncode, output = run_monitored(args, cwd=tmpdir,
+                                           timeout=SETTINGS.yle_timeout,
+                                           callback=show_progress,
+                                           stop=stop)
+    finally:
+        _progress.pop(path, None)
+        if verbose:
+            print(file=sys.stderr)
+    if returncode != 0:
+        log.error('Yle download failed (%s): %s', returncode, path)
+        log.error(output[-2000:])
         return False
 
     # Move media file to destination.
@@ -87,8 +229,119 @@ def iter_subfiles(path):
     return path.parent.glob(f'{path.name}.*.srt')
 
 
+class ProbeCache():
+    """Persistent cache of media info, keyed by path. An entry is valid only
+    while the file has the same size, modification time, and inode, so changed
+    files are probed again automatically.
+
+    Additions are written at exit, merged with those of concurrent processes.
+    """
+    def __init__(self, path):
+        self.path = Path(path)
+        self.lock_path = self.path.with_suffix('.lock')
+        self.lock = threading.Lock()
+        self.data = None  # Path -> dict(stamp=..., info=...).
+        self.added = {}  # Additions not yet written.
+        atexit.register(self.write)
+
+    @staticmethod
+    def stamp(path):
+        """Return file identity and version as a list."""
+        st = os.stat(path)
+        return [st.st_size, st.st_mtime_ns, st.st_ino]
+
+    def _read(self):
+        try:
+            with self.path.open() as fp:
+                return json.load(fp)
+        except FileNotFoundError:
+            return {}
+        except ValueError:
+            log.error('Discarding invalid probe cache: %s', self.path)
+            return {}
+
+    def get(self, path):
+        """Return cached media info for file, or None."""
+        key = os.path.abspath(path)
+        stamp = self.stamp(path)
+        with self.lock:
+            if self.data is None:
+                self.data = self._read()
+            item = self.data.get(key)
+        if item is not None and item['stamp'] == stamp:
+            return item['info']
+        return None
+
+    def put(self, path, info):
+        """Cache media info for file."""
+        item = dict(stamp=self.stamp(path), info=info)
+        with self.lock:
+            if self.data is None:
+                self.data = self._read()
+            self.data[os.path.abspath(path)] = item
+            self.added[os.path.abspath(path)] = item
+
+    def write(self):
+        """Write additions, if any."""
+        with self.lock:
+            if not self.added:
+                return
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            with self.lock_path.open('a') as lockfile:
+                fcntl.flock(lockfile, fcntl.LOCK_EX)
+                data = self._read()
+                data.update(self.added)
+                tmp = self.path.with_suffix('.tmp')
+                with tmp.open('w') as fp:
+                    json.dump(data, fp)
+                os.replace(tmp, self.path)
+            self.data = data
+            self.added.clear()
+
+
 def get_media_info(path):
-    """Return information about media file as a dictionary."""
+    """Return information about media file as a dictionary. Results are
+    cached if a probe cache is configured.
+    """
+    if _probe_cache is not None:
+        try:
+            info = _probe_cache.get(path)
+        except FileNotFoundError:
+            return None
+        if info is not None:
+            return info
+    info = probe(path)
+    if info is not None and _probe_cache is not None:
+        _probe_cache.put(path, info)
+    return info
+
+
+def probe_files(paths, jobs=1, force=False):
+    """Probe media files concurrently, filling the probe cache. Generate
+    (path, info) pairs in order of completion. Files already in cache are
+    skipped unless forced.
+    """
+    if _probe_cache is not None and not force:
+        paths = [x for x in paths if _probe_cache.get(x) is None]
+
+    def run(path):
+        info = probe(path)
+        if info is not None and _probe_cache is not None:
+            _probe_cache.put(path, info)
+        return info
+
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        futures = {executor.submit(run, x): x for x in paths}
+        try:
+            for future in as_completed(futures):
+                yield futures[future], future.result()
+        finally:
+            for future in futures:
+                future.cancel()
+
+
+def probe(path):
+    """Run ffprobe on media file, return information as a dictionary."""
     s = '''ffprobe
         -hide_banner -loglevel fatal
         -of json
@@ -114,21 +367,119 @@ def get_duration(path):
     return datetime.timedelta(seconds=seconds)
 
 
-def normalize_volume(path):
-    """Normalize volume."""
+def normalize_volume(path, quiet=False):
+    """Normalize volume. If quiet, output is discarded."""
     # args = fmt_args('volnorm -s {path}', path=path)
     quoted = shlex.quote(str(path))
     cmd = f'volnorm -s {quoted}'
     args = shlex.split(cmd)
+    if quiet:
+        return call(args, stdout=subprocess.DEVNULL,
+                    stderr=subprocess.DEVNULL)
     return call(args)
 
 
+@contextmanager
+def lock_file(path):
+    """Hold an exclusive advisory lock on file, shared between threads and
+    processes. If the file is replaced meanwhile, the lock is on the old one,
+    so check its state again after locking.
+    """
+    with open(path, 'rb') as fp:
+        fcntl.flock(fp, fcntl.LOCK_EX)
+        yield
+
+
+def transcode(src, dst, bitrate='32k', gain=None):
+    """Transcode media to mono Opus tuned for speech, applying gain (in dB)
+    if given. Return True if successful.
+    """
+    af = [] if gain is None else ['-af', f'volume={gain.value}dB']
+    args = ['ffmpeg', '-nostdin', '-hide_banner', '-loglevel', 'error', '-y',
+            '-i', str(src), '-vn', '-map_metadata', '0', *af, '-ac', '1',
+            '-c:a', 'libopus', '-b:a', bitrate, '-application', 'voip',
+            '-f', 'opus', str(dst)]
+    return call(args) == 0
+
+
+class LoudnessAnalyzer():
+    """ReplayGain analysis of a byte stream fed while it is being written to
+    disk, using an ffmpeg subprocess. Failures only disable the analysis.
+    """
+    def __init__(self):
+        self.proc = None
+        self.output = []
+        self.failed = False
+        args = shlex.split('ffmpeg -hide_banner -nostats -i pipe:0 '
+                           '-vn -af replaygain -f null -')
+        log.info('Running: %s', ' '.join(args))
+        try:
+            self.proc = subprocess.Popen(args, stdin=subprocess.PIPE,
+                                         stdout=subprocess.DEVNULL,
+                                         stderr=subprocess.PIPE)
+        except FileNotFoundError:
+            log.error('Command not found: %s', args[0])
+            self.failed = True
+            return
+        # Drain messages, so that ffmpeg never blocks on them.
+        self.reader = threading.Thread(target=self._read, daemon=True)
+        self.reader.start()
+
+    def _read(self):
+        for line in self.proc.stderr:
+            self.output.append(line.decode(errors='replace'))
+
+    def write(self, data):
+        """Feed data."""
+        if self.failed:
+            return
+        try:
+            self.proc.stdin.write(data)
+        except OSError as e:
+            log.error('Loudness analysis failed: %s', e)
+            self.abort()
+
+    def abort(self):
+        """Stop analysis."""
+        self.failed = True
+        if self.proc is not None:
+            self.proc.kill()
+            self.proc.wait()
+
+    def finish(self, path):
+        """End stream and store result as ReplayGain attribute of file.
+        Return Gain, or None if analysis failed.
+        """
+        if self.failed:
+            return None
+        try:
+            self.proc.stdin.close()
+        except OSError:
+            pass
+        self.proc.wait()
+        self.reader.join()
+        m = re.search(r'track_gain = ([-+]?\d+(?:\.\d+)?) dB',
+                      ''.join(self.output))
+        if self.proc.returncode or m is None:
+            log.error('Loudness analysis failed: %s: %s', path,
+                      ''.join(self.output[-3:]).strip())
+            return None
+        gain = Gain(float(m.group(1)), 'dB')
+        set_gain(path, gain)
+        log.info('Analyzed loudness: %s: %s', path, gain)
+        return gain
+
+
+def set_gain(path, gain):
+    """Set ReplayGain level."""
+    XAttrStr(path)[GAIN_KEY] = str(gain)
+
+
 def get_gain(path):
     """Get ReplayGain level."""
-    key = 'user.loudness.replaygain_track_gain'
     try:
         attrs = XAttrStr(path)
-        gain = Gain.parse(attrs[key])
+        gain = Gain.parse(attrs[GAIN_KEY])
     except (FileNotFoundError, KeyError):
         return None
     except ValueError:
@@ -167,6 +518,18 @@ def play_file(path, start=None):
     return call(args)
 
 
+def play_url(url, start=None):
+    """Play media from URL, optionally starting at a fraction of duration."""
+    rp = '--replaygain=track'
+    ad = '--audio-display=no'
+    if start is not None:
+        st = f'--start={start * 100}%'
+    else:
+        st = ''
+    args = shlex.split(f'mpv {rp} {ad} {st} {shlex.quote(url)}')
+    return call(args)
+
+
 def play_stream(url):
     """Play media."""
     # TODO: Obsolete, replace wth `stream()`. Just check those arguments...
@@ -0,0 +1,191 @@
+"""Long-lived media player controlled over mpv JSON IPC."""
+
+import json
+import logging
+import shutil
+import socket
+import subprocess
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+log = logging.getLogger(__name__)
+
+
+class PlayerError(Exception):
+    """Player command failed."""
+
+
+class Player():
+    """An mpv process that is started once and reused for playing files,
+    without blocking the caller. Playback position is reported to a callback
+    per file, at most every `interval` seconds, and always when the file ends.
+    """
+    def __init__(self, interval=15, timeout=5):
+        self.interval = interval  # Seconds between progress reports.
+        self.timeout = timeout  # Seconds to wait for mpv.
+        self.proc = None
+        self.sock = None
+        self.tmpdir = None
+        self.lock = threading.Lock()  # Serialize sending.
+        self.request_id = 0
+        self.responses = {}  # Request id -> [event, response].
+        self.callbacks = {}  # Path -> progress callback.
+        self.path = None  # Path playing now.
+        self.position = None  # Position in current file, as fraction.
+        self.reported = 0  # Time of last progress report.
+        self.last = None  # Last reported path and position.
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.quit()
+
+    @property
+    def alive(self):
+        """Is player process running?"""
+        return self.proc is not None and self.proc.poll() is None
+
+    def start(self):
+        """Start player process, if not running."""
+        if self.alive:
+            return
+        self.close()
+        self.tmpdir = Path(tempfile.mkdtemp(prefix='mpv'))
+        sock_path = self.tmpdir / 'socket'
+        args = ['mpv', '--idle=yes', '--no-terminal', '--force-window=no',
+                '--audio-display=no', '--replaygain=track',
+                f'--input-ipc-server={sock_path}']
+        log.info('Running: %s', ' '.join(args))
+        self.proc = subprocess.Popen(args, stdin=subprocess.DEVNULL)
+        deadline = time.monotonic() + self.timeout
+        while True:
+            try:
+                self.sock = socket.socket(socket.AF_UNIX)
+                self.sock.connect(str(sock_path))
+                break
+            except (FileNotFoundError, ConnectionRefusedError):
+                self.sock.close()
+                if not self.alive or time.monotonic() > deadline:
+                    self.close()
+                    raise PlayerError('Cannot connect to mpv')
+                time.sleep(0.05)
+        reader = threading.Thread(target=self._read, args=(self.sock,),
+                                  daemon=True)
+        reader.start()
+        self.command('observe_property', 1, 'path')
+        self.command('observe_property', 2, 'percent-pos')
+
+    def command(self, *args):
+        """Run command, return its result."""
+        with self.lock:
+            self.request_id += 1
+            request_id = self.request_id
+            waiter = self.responses[request_id] = [threading.Event(), None]
+            msg = dict(command=list(args), request_id=request_id)
+            try:
+                self.sock.sendall(json.dumps(msg).encode() + b'\n')
+            except OSError as e:
+                del self.responses[request_id]
+                raise PlayerError(f'Cannot send to mpv: {e}')
+        if not waiter[0].wait(self.timeout):
+            self.responses.pop(request_id, None)
+            raise PlayerError(f'No response from mpv: {args}')
+        response = waiter[1]
+        if response.get('error') != 'success':
+            raise PlayerError(f'{args}: {response.get("error")}')
+        return response.get('data')
+
+    def play(self, path, start=None, gain=None, callback=None):
+        """Play file, replacing the current one, starting at fraction of
+        duration, with fallback gain in dB for files without ReplayGain tags.
+        Call callback(path, fraction) with playback progress.
+        """
+        self.start()
+        if callback is not None:
+            self.callbacks[str(path)] = callback
+        self.command('set_property', 'start',
+                     'none' if start is None else f'{start * 100}%')
+        self.command('set_property', 'replaygain-fallback',
+                     0 if gain is None else gain.value)
+        self.command('loadfile', str(path), 'replace')
+        self.command('set_property', 'pause', False)
+
+    def pause(self):
+        """Toggle pause."""
+        if self.alive:
+            self.command('cycle', 'pause')
+
+    def stop(self):
+        """Stop playback."""
+        if self.alive:
+            self.command('stop')
+
+    def quit(self):
+        """Stop player process."""
+        if self.alive:
+            try:
+                self.command('quit')
+                self.proc.wait(self.timeout)
+            except (PlayerError, subprocess.TimeoutExpired):
+                self.proc.kill()
+        self.close()
+
+    def close(self):
+        """Release resources."""
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+        if self.tmpdir is not None:
+            shutil.rmtree(self.tmpdir, ignore_errors=True)
+            self.tmpdir = None
+
+    def _read(self, sock):
+        """Handle messages from player (run in reader thread)."""
+        with sock.makefile('rb') as fp:
+            for line in fp:
+                try:
+                    msg = json.loads(line)
+                except ValueError:
+                    log.error('Invalid message from mpv: %s', line)
+                    continue
+                if 'request_id' in msg:
+                    waiter = self.responses.pop(msg['request_id'], None)
+                    if waiter is not None:
+                        waiter[1] = msg
+                        waiter[0].set()
+                else:
+                    self._event(msg)
+        self._report(force=True)
+
+    def _event(self, msg):
+        """Handle player event."""
+        event = msg.get('event')
+        if event == 'property-change' and msg['name'] == 'path':
+            self._report(force=True)
+            self.path = msg.get('data')
+            self.position = None
+        elif event == 'property-change' and msg['name'] == 'percent-pos':
+            if msg.get('data') is not None:
+                self.position = msg['data'] / 100
+                self._report()
+        elif event == 'end-file' and msg.get('reason') == 'eof':
+            self.position = 1
+            self._report(force=True)
+
+    def _report(self, force=False):
+        """Pass progress to callback, if it is time."""
+        now = time.monotonic()
+        if self.position is None or not (force or
+                                         now - self.reported > self.interval):
+            return
+        callback = self.callbacks.get(self.path)
+        if callback is not None and self.last != (self.path, self.position):
+            self.reported = now
+            self.last = self.path, self.position
+            try:
+                callback(self.path, self.position)
+            except Exception:
+                log.exception('Progress callback failed: %s', self.path)
@@ -4,16 +4,32 @@
 
 # FIXME: Don't use logging for normal output.
 
+import atexit
 import logging
+import time
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from itertools import chain
 from pathlib import Path
 
+from boltons.strutils import bytes2human
+
 from jupitotools.args import get_basic_parser
 from jupitotools.files import tempfile_and_backup, valid_lines
 from jupitotools.misc import get_loglevel, get_progname
 
 import common
+import dlqueue
+import download
+import fetch
+import fuzzy
+import media
+import player
+import query
+import store
+import sync
+import textindex
+import throttle
 import ui_cmd
 import util
 from misctypes import Flag
@@ -28,21 +44,47 @@ class Proc():
     """Program process state information."""
     session_path = user_dirs.user_cache_dir / 'session.json'
     orphans_path = user_dirs.user_cache_dir / 'orphans.txt'
+    dlqueue_path = user_dirs.user_cache_dir / 'dlqueue.json'
+    bwlimit_path = user_dirs.user_cache_dir / 'bwlimit'
+    probe_cache_path = user_dirs.user_cache_dir / 'probe.json'
+    transcode_dir = user_dirs.user_cache_dir / 'transcode'
+    search_index_path = user_dirs.user_cache_dir / 'search.sqlite'
 
     def __init__(self, args):
         self.args = args
         self.session = common.TextDict(self.session_path)
+        self.dlqueue = dlqueue.DownloadQueue(self.dlqueue_path)
+        self.player = None  # Persistent player for UI, if enabled.
+        if args.mpv_ipc:
+            self.player = player.Player()
+            atexit.register(self.player.quit)
         # TODO: Use only --view.
         self.view = common.View(directory=args.directory, flags=args.flags,
                                 number=args.number, sortkey=args.sortkey,
                                 sortkey2=args.sortkey2)
         if args.view:
             self.view = self.view.parse(args.view)
+            if self.view.query:
+                query.Query.parse(self.view.query)  # Fail early if invalid.
         self.views = {}  # Optional feed-specific views.
         self.cache_feeds = False
         self.open_feeds = {}
+        self.library = None  # Index of cached feeds for queries.
+        self.search_index = None  # Full-text index, opened when needed.
         if args.recursive:
             self.view.directory = self.read_recursive_dirs(self.view.directory)
+        fetch.configure(segments=args.segments,
+                        segment_threshold=args.segment_threshold * 1024**2,
+                        segments_per_host=args.segments_per_host,
+                        probe_ranges=args.probe_ranges)
+        store.configure(args.store)
+        media.configure(yle_jobs=args.yle_jobs,
+                        yle_timeout=args.yle_timeout and args.yle_timeout * 60,
+                        probe_cache=self.probe_cache_path,
+                        inline_loudness=args.inline_loudness)
+        throttle.configure(rate=throttle.parse_rate(args.bwlimit),
+                           schedule=args.bwschedule,
+                           control_path=self.bwlimit_path)
 
     @staticmethod
     def read_recursive_dirs(paths):
@@ -71,16 +113,54 @@ class Proc():
         # if view is None:
         #     view = self.view
         # d = dict(flags=view.flags, number=view.number, sortkey=view.sortkey)
+        queries = {}  # Query string -> parsed query.
+        selections = {}  # Query -> matching entries by directory.
         for feed in self.generate_feeds(view=view):
             v = view or self.views.get(feed.directory) or self.view
             d = dict(flags=v.flags, number=v.number, sortkey=v.sortkey)
+            if v.query:
+                if v.query not in queries:
+                    queries[v.query] = query.Query.parse(v.query)
+                d['entries'] = self.query_entries(feed, queries[v.query],
+                                                  selections)
             log.debug('Using view: %s: %s', feed, d)
             for entry in feed.list_entries(**d):
                 yield entry
 
+    def query_entries(self, feed, q, selections):
+        """Return entries of feed matching query. Cached feeds are indexed,
+        and queried all at once.
+        """
+        if not self.cache_feeds:
+            return q.filter(feed.entries)
+        if self.library is None:
+            self.library = query.Library(self.generate_feeds())
+        if feed.directory not in self.library.directories:
+            return q.filter(feed.entries)
+        if q not in selections:
+            selections[q] = self.library.select(q)
+        return selections[q].get(feed.directory, [])
+
+    def get_search_index(self):
+        """Return full-text index, updated for feeds in view."""
+        if self.search_index is None:
+            self.search_index = textindex.TextIndex(self.search_index_path)
+            atexit.register(self.search_index.close)
+        self.search_index.sync(self.view.directory)
+        return self.search_index
+
+    def search(self, terms):
+        """Search entries in view by full-text index. Return list of
+        (directory, guid, date, title), best first.
+        """
+        return self.get_search_index().search(terms, self.view.directory)
+
     def clear_cache(self):
         """Clear feed cache."""
         self.open_feeds = {}
+        if self.library is not None:
+            self.library.close()
+            self.library = None
 
     def add_urls(self, urls):
         """Add feeds from URLs."""
@@ -96,10 +176,29 @@ class Proc():
         urls = chain(self.args.url or [], file_urls)
         self.add_urls(urls)
 
+    def get_dl_view(self, feed):
+        """Return feed-specific download view from the 'dl' tag, or None."""
+        s = feed.get_tags().get('dl')
+        if s:
+            return self.view.parse(f',{s},,')
+        return None
+
+    def read_dl_views(self):
+        """Read feed-specific download views, unless --force is used."""
+        if not self.args.force:
+            for feed in self.generate_feeds():
+                view = self.get_dl_view(feed)
+                if view is not None:
+                    self.views[feed.directory] = view
+                    # print(feed, self.views[feed.directory])
+
     def cmd_refresh(self):
-        """Refresh feeds. Using --force forces retrieval."""
+        """Refresh feeds. Using --force forces retrieval. Using --enqueue adds
+        downloads from refreshed feeds to download queue.
+        """
         n_skipped = 0
         n_new = 0
+        n_queued = 0
         for feed in self.generate_feeds():
             r = feed.refresh(gracetime=self.args.gracetime,
                              force=self.args.force)
@@ -107,10 +206,23 @@ class Proc():
                 n_skipped += 1
             else:
                 n_new += r
+                if r and self.args.enqueue:
+                    v = self.get_dl_view(feed) or self.view
+                    entries = feed.list_entries(flags=v.flags, number=v.number,
+                                                sortkey=v.sortkey)
+                    n_queued += self.dlqueue.enqueue(
+                        entries, maxsize=self.args.maxsize)
         if self.args.verbose:
             s = 'Found {} new entries in {} feeds, skipped {} feeds'
             messager.msg(s.format(n_new, len(self.view.directory) - n_skipped,
                                   n_skipped))
+            if self.args.enqueue:
+                messager.msg(f'Queued {n_queued} downloads')
+        if n_new:
+            try:
+                self.get_search_index()  # Update it now, not on search.
+            except textindex.SearchError as e:
+                log.error(e)
 
     def cmd_check(self, path=None):
         """Check feeds. Write list of orphaned files. Using --force forces
@@ -128,25 +240,158 @@ class Proc():
         if orphans:
             write_pathlist(orphans, path)
 
+    def make_plan(self):
+        """Plan downloads from view and download queue, and show the plan."""
+        # First read any feed-specific settings.
+        self.read_dl_views()
+        encs = []
+        waiting = self.dlqueue.waiting_keys()  # Not claimed before retry.
+        for entry in self.generate_entries():
+            for enc in entry.encs():
+                if dlqueue.enc_key(enc) in waiting:
+                    log.debug('Waiting for retry: %s', enc.path)
+                elif enc.is_too_big(self.args.maxsize):
+                    log.warning('Download too big: %s: %s',
+                                bytes2human(enc.length or 0), enc.path)
+                else:
+                    encs.append(enc)
+        encs.extend(self.dlqueue.pending_encs())
+        budget = self.args.budget
+        if budget is not None:
+            budget *= 1024**2
+        plan = download.plan_downloads(encs, budget=budget,
+                                       reserve=self.args.reserve * 1024**2,
+                                       jobs=self.args.jobs)
+        plan.show(verbose=self.args.verbose)
+        return plan
+
+    def cmd_plan(self):
+        """Show download plan."""
+        self.make_plan()
+
     def cmd_dl(self):
         """Download enclosures. Using --force forces download even against feed
-        settings.
+        settings. Pending downloads in the download queue are included, and
+        files are chosen by entry score to fit in --budget and free space.
         """
-        # First read any feed-specific settings.
-        if not self.args.force:
-            for feed in self.generate_feeds():
-                s = feed.get_tags().get('dl')
-                if s:
-                    view = self.view.parse(f',{s},,')
-                    self.views[feed.directory] = view
-                    # print(feed, self.views[feed.directory])
-        for entry in self.generate_entries():
-            common.download_enclosures(entry, self.args.maxsize)
+        plan = self.make_plan()
+        encs = [x[0] for x in plan.selected]
+        n = self.dlqueue.enqueue_encs(encs)
+        log.debug('Queued %i downloads', n)
+        keys = {dlqueue.enc_key(x) for x in encs}
+        with download.DownloadManager(jobs=self.args.jobs) as manager:
+            self.dlqueue.drain(manager, keys=keys)
+
+    def cmd_drain(self):
+        """Download everything due in download queue."""
+        with download.DownloadManager(jobs=self.args.jobs) as manager:
+            self.dlqueue.drain(manager)
+
+    def cmd_show_queue(self):
+        """Show download queue."""
+        rows = [[x['state'], x['attempts'], x['priority'], x['feed'],
+                 x['href']] for x in self.dlqueue.jobs()]
+        if rows:
+            messager.msg(util.fmt_table(rows))
+
+    def cmd_dedup(self):
+        """Add existing enclosure files to store, replacing duplicates with
+        hardlinks, and remove stored files no longer used by any feed.
+        """
+        enc_store = store.get_store()
+        if enc_store is None:
+            log.error('No store configured, use --store')
+            return
+        reclaimed = 0
+        for feed in self.generate_feeds():
+            for entry in feed.entries:
+                reclaimed += common.dedup_enclosures(entry, enc_store)
+        enc_store.write()
+        freed = enc_store.prune()
+        messager.msg(f'Reclaimed {bytes2human(reclaimed)} from duplicates, '
+                     f'freed {bytes2human(freed)} of unused files')
+
+    def cmd_probe(self):
+        """Probe media info of all downloaded enclosures concurrently, filling
+        the cache. Using --force probes cached files again.
+        """
+        paths = {x.path for feed in self.generate_feeds()
+                 for entry in feed.entries for x in entry.encs()
+                 if x.path.exists()}
+        n = nbytes = nfailed = 0
+        start = time.monotonic()
+        for path, info in media.probe_files(sorted(paths), jobs=self.args.jobs,
+                                            force=self.args.force):
+            n += 1
+            nfailed += info is None
+            nbytes += path.stat().st_size
+            elapsed = max(time.monotonic() - start, 0.001)
+            messager.msg(f'[{n}] {n / elapsed:.1f} files/s, '
+                         f'{bytes2human(nbytes / elapsed)}/s: {path}',
+                         end='\r', flush=True, truncate=True)
+        elapsed = time.monotonic() - start
+        messager.msg(f'Probed {n} files in {elapsed:.0f} s, {nfailed} failed, '
+                     f'{len(paths) - n} cached')
+
+    def cmd_bwlimit(self):
+        """Change bandwidth limit of running processes to --bwlimit, or
+        remove the override if not given.
+        """
+        if self.args.bwlimit is None:
+            messager.msg('Removing bandwidth limit override')
+        else:
+            rate = throttle.parse_rate(self.args.bwlimit)
+            messager.msg(f'Setting bandwidth limit: {rate or "none"} B/s')
+        throttle.write_control(self.bwlimit_path, self.args.bwlimit)
 
     def cmd_norm(self):
-        """Normalize enclosure loudness. Using --force re-normalizes."""
-        for entry in self.generate_entries():
-            common.normalize_enclosures(entry, force=False)
+        """Normalize enclosure loudness using --jobs concurrent jobs. Using
+        --force re-normalizes.
+        """
+        force = self.args.force
+        encs = [x for entry in self.generate_entries()
+                if force or 'nonorm' not in entry.feed.get_tags()
+                for x in entry.encs() if x.path.exists()]
+        if not force:
+            encs = [x for x in encs if not x.is_normalized()]
+        if not encs:
+            return
+        jobs = max(1, self.args.jobs)
+        messager.msg(f'Normalizing {len(encs)} files in {jobs} jobs')
+
+        def normalize(enc):
+            try:
+                return common.normalize_enclosure(enc, force=force,
+                                                  quiet=jobs > 1)
+            except OSError as e:
+                log.error('Cannot normalize: %s: %s', enc.path, e)
+                return False
+
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            for enc, done in zip(encs, executor.map(normalize, encs)):
+                if done and jobs > 1:
+                    messager.msg(f'Normalized: {enc.path}')
+
+    def cmd_sync(self):
+        """Transcode first --sync_count downloaded enclosures to compact Opus
+        files, and replace the files in --sync_dir with them.
+        """
+        if self.args.sync_dir is None:
+            log.error('No destination given, use --sync_dir')
+            return
+        paths = [x.path for entry in self.generate_entries()
+                 for x in entry.encs() if x.path.exists()]
+        paths = paths[:self.args.sync_count]
+        cache = sync.TranscodeCache(self.transcode_dir,
+                                    bitrate=self.args.bitrate)
+        written = sync.sync(paths, self.args.sync_dir, cache,
+                            jobs=self.args.jobs)
+        size = sum(x.stat().st_size for x in written)
+        messager.msg(f'Synced {len(written)} of {len(paths)} files '
+                     f'({bytes2human(size)}) to {self.args.sync_dir}')
+        freed = cache.prune()
+        if freed:
+            messager.msg(f'Pruned {bytes2human(freed)} from transcode cache')
 
     def cmd_setflag(self):
         """Set flag for entries to --new_flag value."""
@@ -228,6 +473,38 @@ class Proc():
             for entry in sorted(v):
                 common.show_entry(entry, verbose=self.args.verbose)
 
+    def cmd_search(self):
+        """Search entries by --terms. A term ending with '*' is a prefix, a
+        term with spaces a phrase.
+        """
+        if not self.args.terms:
+            log.error('No search terms given, use --terms')
+            return
+        try:
+            results = self.search(self.args.terms)
+        except textindex.SearchError as e:
+            log.error(e)
+            return
+        for directory, _, date, title in results:
+            date = (date or '')[:10]
+            messager.msg(f'{date} {directory}: {title}')
+
+    def cmd_fuzzy(self):
+        """Fuzzy search entries by entry and feed titles, and tags, with
+        --terms. Print matches ranked by similarity and entry score.
+        """
+        if not self.args.terms:
+            log.error('No search terms given, use --terms')
+            return
+        entries = [x for feed in self.generate_feeds() for x in feed.entries]
+        index = fuzzy.FuzzyIndex(entries)
+        for score, i in index.search(' '.join(self.args.terms),
+                                     limit=self.args.number):
+            entry = entries[i]
+            date = util.time_fmt(entry.date, fmt='isodate')
+            messager.msg(f'{score:3.0f} {date} {entry.feed.directory}: '
+                         f'{entry}')
+
     def cmd_ui(self):
         """Run UI."""
         ui = ui_cmd.UI(self)
@@ -281,7 +558,7 @@ def parse_args():
     parser.add('-r', '--recursive', action='store_true', default=True,
                help='recurse directories')
     parser.add('-w', '--view',
-               help='view (f,n,s,S)')
+               help='view (f,n,s,S,q), where q is an entry query')
     parser.add('-u', '--url', nargs='*',
                help='URLs to add')
     parser.add('-U', '--urllist', nargs='*',
@@ -292,6 +569,48 @@ def parse_args():
                help='refresh grace time in hours')
     parser.add('--maxsize', type=float, default=350,
                help='maximum download size (MB)')
+    parser.add('--yle_jobs', type=int, default=2,
+               help='number of concurrent Yle Areena downloads')
+    parser.add('--yle_timeout', type=float,
+               help='Yle Areena download timeout (minutes)')
+    parser.add('--mpv_ipc', action='store_true',
+               help='play in UI with a persistent mpv process')
+    parser.add('--inline_loudness', action='store_true',
+               help='analyze loudness while downloading (not segmented)')
+    parser.add('--bwlimit', type=throttle.rate_arg,
+               help='bandwidth limit per second, like 500K or 2M')
+    parser.add('--bwschedule', type=throttle.parse_schedule,
+               help='bandwidth limit schedule, like 08:00-23:00=500K,...')
+    parser.add('--budget', type=float,
+               help='maximum total download size per run (MB)')
+    parser.add('--reserve', type=float, default=1024,
+               help='free disk space to leave when downloading (MB)')
+    parser.add('--prefetch', type=int, default=0,
+               help='number of upcoming entries to prefetch in UI')
+    parser.add('--prefetch_size', type=float, default=500,
+               help='maximum total size of prefetched downloads (MB)')
+    parser.add('--store', type=Path,
+               help='content-addressed enclosure store directory')
+    parser.add('--enqueue', action='store_true',
+               help='queue downloads from refreshed feeds')
+    parser.add('--jobs', type=int, default=4,
+               help='number of concurrent jobs')
+    parser.add('--segments', type=int, default=1,
+               help='maximum connections per large download')
+    parser.add('--segment_threshold', type=float, default=100,
+               help='minimum size for segmented download (MB)')
+    parser.add('--segments_per_host', type=int, default=4,
+               help='maximum segment connections per host')
+    parser.add('--probe_ranges', action='store_true',
+               help='probe range support when Accept-Ranges is missing')
+    parser.add('--sync_dir', type=Path,
+               help='destination directory for sync command')
+    parser.add('--sync_count', type=int, default=15,
+               help='number of files to sync')
+    parser.add('--bitrate', default='32k',
+               help='Opus bitrate for sync transcoding')
+    parser.add('--terms', nargs='+',
+               help='terms for search and fuzzy commands')
     parser.add('--force', action='store_true',
                help='force operation (depends on command)')
 
@@ -314,7 +633,11 @@ def main():
     logging.basicConfig(filename=args.logfile,
                         level=get_loglevel(args.loglevel))
     args = util.AttrDict(args.__dict__)
-    proc = Proc(args)
+    try:
+        proc = Proc(args)
+    except query.QueryError as e:
+        log.error('Invalid view query: %s', e)
+        raise SystemExit(1)
     for cmd in args.commands:
         proc.run_cmd(cmd)
 
@@ -119,11 +119,11 @@ _call_ui_iot() { podxm -c ui -w foin,-1,d,d -d $(_dirs iot); }
 _call_dl_t() { reallynice podxm -c dl -w n,1,D,SD -d $(_dirs talk); }
 _call_dl_c() { reallynice podxm -c dl -w n,1,d,Sd -d $(_dirs complete); }
 _call_dl_m() { reallynice podxm -c dl -w n,1,d,Sd -d $(_dirs music); }
-_call_dl_v() { reallynice podxm -c dl -w n,1,d,Sd -d $(_dirs video); }
+_call_dl_v() { reallynice podxm -c dl --segments 4 -w n,1,d,Sd -d $(_dirs video); }
 _call_dl_i() { reallynice podxm -c dl -w oia,-1,,SD --force -d ./*; }
 
 #_call_norm() { reallynice podxm -c norm -w foina,-1,,SD -d ./*; }
-_call_norm() { njobs=1 _dirs all | _xe1 podxm -c norm -w foina,-1,,SD -d; }
+_call_norm() { reallynice podxm -c norm --jobs 8 -w foina,-1,,SD -d $(_dirs all); }
 _call_check() { _dirs all | _xe podxm -c check -w foinad,-1,, -d .; }  # TODO: Do only once
 
 _sync_playlists() {
@@ -135,7 +135,6 @@ _sync_playlists() {
 _sync_podcasts() {
     # Sync files with portable device.
     #echo "Syncing podcasts: $0..."
-    tmp="$(_tmpfile)"
     n=15
     prefix="$1"
     dst="$portable_podcasts_dir/$prefix"
@@ -145,19 +144,15 @@ _sync_podcasts() {
     #dirs="$(echo $podcasts_dir/!(complete*|done*|video*))"
     #dirs="$(echo $podcasts_dir/ongoing/"$prefix"*)"
     dirs="$(echo $podcasts_dir/*/"$prefix"*)"
-    cmd="podxm -c show_files -w oin,1,D,D -d $dirs"
-
-    $cmd | grep '\.\(mp3\|ogg\)' | head -n $n > "$tmp"
-
-    #nfiles="$(wc -l < $tmp)"
-    #size="$(xargs du -chs < $tmp | tail -n 1)"
-    #echo "$prefix: $nfiles files, "$size""
-
-    #less "$tmp"
-    mkdir -p "$dst"
-    rm -rf "${dst:?}"/*
-    xargs ln -f -t "$dst" < "$tmp"
-    rm "$tmp"
+    #cmd="podxm -c show_files -w oin,1,D,D -d $dirs"
+    #$cmd | grep '\.\(mp3\|ogg\)' | head -n $n > "$tmp"
+    #mkdir -p "$dst"
+    #rm -rf "${dst:?}"/*
+    #xargs ln -f -t "$dst" < "$tmp"
+
+    # Transcoded files are cached, so only new ones are encoded.
+    reallynice podxm -c sync --sync_dir "$dst" --sync_count $n --jobs 8 \
+        -w oin,1,D,D -d $dirs
     _du "$dst"
 }
 
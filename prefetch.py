@@ -0,0 +1,100 @@
+"""Background download and normalization of upcoming entries."""
+
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import common
+
+log = logging.getLogger(__name__)
+
+
+class Prefetcher():
+    """Download and normalize enclosures of the next few entries in a
+    background thread, so that they are ready when played.
+
+    Work is done one enclosure at a time. When the target changes, queued work
+    that is no longer wanted is cancelled; an enclosure already being fetched
+    is finished (or left to be resumed later).
+    """
+    def __init__(self, ahead=2, budget=None, maxsize=None):
+        self.ahead = ahead  # Number of entries to prefetch.
+        self.budget = budget  # Maximum bytes to prefetch at a time, or None.
+        self.maxsize = maxsize  # Maximum download size in megabytes.
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.lock = threading.Lock()
+        self.futures = {}  # Destination path -> future.
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def targets(self, entries, i, direction=1):
+        """Return enclosures to prefetch after index i in direction."""
+        encs = []
+        nbytes = 0
+        step = 1 if direction >= 0 else -1
+        indices = range(i + step, i + step * (self.ahead + 1), step)
+        for entry in (entries[x] for x in indices if 0 <= x < len(entries)):
+            for enc in entry.encs():
+                if enc.path.exists() and enc.is_normalized():
+                    continue
+                if not enc.path.exists():
+                    nbytes += enc.length or 0
+                if self.budget is not None and nbytes > self.budget:
+                    return encs
+                encs.append(enc)
+        return encs
+
+    def update(self, entries, i, direction=1):
+        """Prefetch entries ahead of index i in direction, cancelling queued
+        work for others.
+        """
+        encs = self.targets(entries, i, direction=direction)
+        wanted = {x.path for x in encs}
+        with self.lock:
+            for path, future in list(self.futures.items()):
+                if future.done() or (path not in wanted and future.cancel()):
+                    del self.futures[path]
+            for enc in encs:
+                if enc.path not in self.futures:
+                    log.debug('Prefetching: %s', enc.path)
+                    self.futures[enc.path] = self.executor.submit(
+                        self._fetch, enc)
+
+    def cancel(self):
+        """Cancel queued work."""
+        with self.lock:
+            for path, future in list(self.futures.items()):
+                if future.done() or future.cancel():
+                    del self.futures[path]
+
+    def claim(self, entry):
+        """Take over entry: cancel its queued work, and wait for any that is
+        in progress, so that the caller can safely handle its enclosures.
+        """
+        with self.lock:
+            futures = [self.futures.pop(x.path) for x in entry.encs() if
+                       x.path in self.futures]
+        running = [x for x in futures if not x.cancel()]
+        if running:
+            log.info('Waiting for prefetch: %s', entry)
+            wait(running)
+
+    def close(self):
+        """Cancel queued work and wait for work in progress."""
+        self.cancel()
+        self.executor.shutdown(wait=True)
+
+    def _fetch(self, enc):
+        """Download and normalize enclosure (run in worker thread)."""
+        try:
+            if common.download_enclosure(enc, maxsize=self.maxsize,
+                                         progress=False):
+                log.info('Prefetched: %s', enc.path)
+            if 'nonorm' not in enc.entry.feed.get_tags():
+                common.normalize_enclosure(enc, quiet=True)
+        except Exception:  # Never disturb the UI.
+            log.exception('Prefetch failed: %s', enc.path)
@@ -0,0 +1,180 @@
+"""Playback of enclosures while they are being downloaded."""
+
+import logging
+import os
+import re
+import threading
+import time
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import dirstate
+import fetch
+import media
+import store
+
+log = logging.getLogger(__name__)
+
+POLL_INTERVAL = 0.2  # Seconds to wait for more data.
+
+
+class Download():
+    """Enclosure download running in the background as a single stream, so
+    that the file grows from the beginning.
+    """
+    def __init__(self, enc):
+        self.enc = enc
+        self.path = enc.path
+        self.ok = None
+        self.done = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def run(self):
+        analyzer = None
+        if media.SETTINGS.inline_loudness:
+            analyzer = media.LoudnessAnalyzer()
+        try:
+            self.ok = fetch.download(self.enc.href, self.path,
+                                     length=self.enc.length, segmented=False,
+                                     sink=analyzer)
+            if analyzer is not None and self.ok:
+                analyzer.finish(self.path)
+            if self.ok and store.get_store() is not None:
+                store.get_store().add(self.path, self.enc.href)
+        except Exception:
+            log.exception('Download failed: %s', self.path)
+            self.ok = False
+        finally:
+            if analyzer is not None and not self.ok:
+                analyzer.abort()
+            dirstate.invalidate(self.path)
+            self.done.set()
+
+    def available(self):
+        """Return number of bytes that can be read now."""
+        n = fetch.transferred(self.path)
+        if n is not None:
+            return n
+        if self.ok:
+            return self.path.stat().st_size
+        return 0
+
+    def total(self):
+        """Return total size, or None if not known (yet)."""
+        if self.ok:
+            return self.path.stat().st_size
+        return fetch.read_meta(self.path).get('length') or self.enc.length
+
+    def open(self):
+        """Open the growing file (or the finished one) for reading."""
+        while True:
+            for path in [fetch.part_path(self.path), self.path]:
+                try:
+                    return path.open('rb')
+                except FileNotFoundError:
+                    pass
+            if self.done.is_set() and not self.ok:
+                raise FileNotFoundError(self.path)
+            time.sleep(POLL_INTERVAL)
+
+    def wait_for(self, pos):
+        """Wait until data past position is available. Return number of bytes
+        available, or 0 if it never will be.
+        """
+        while True:
+            n = self.available()
+            if n > pos:
+                return n
+            if self.done.is_set():
+                return self.available() if self.ok else 0
+            time.sleep(POLL_INTERVAL)
+
+
+class Handler(BaseHTTPRequestHandler):
+    """Serve the file of a download, waiting for data as needed."""
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        log.debug(format, *args)
+
+    def do_GET(self):  # noqa: N802 (function name should be lowercase)
+        download = self.server.download
+        # Wait for the server to tell us the size before answering.
+        if not download.wait_for(0):
+            self.send_error(HTTPStatus.BAD_GATEWAY)
+            return
+        total = download.total()
+        start = 0
+        m = re.match(r'bytes=(\d+)-', self.headers.get('Range', ''))
+        if m and total:
+            start = int(m.group(1))
+            self.send_response(HTTPStatus.PARTIAL_CONTENT)
+            self.send_header('Content-Range',
+                             f'bytes {start}-{total - 1}/{total}')
+        else:
+            self.send_response(HTTPStatus.OK)
+        if total:
+            self.send_header('Content-Length', str(total - start))
+            self.send_header('Accept-Ranges', 'bytes')
+        else:
+            self.close_connection = True
+        self.send_header('Content-Type', download.enc.typ or
+                         'application/octet-stream')
+        self.end_headers()
+        try:
+            with download.open() as fp:
+                self.copy(fp, start, total)
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # Player seeked or quit.
+
+    def copy(self, fp, pos, total):
+        """Copy data to client as it becomes available."""
+        download = self.server.download
+        while total is None or pos < total:
+            available = download.wait_for(pos)
+            if available <= pos:
+                break  # Download failed or finished short.
+            n = min(fetch.CHUNK_SIZE, available - pos)
+            data = os.pread(fp.fileno(), n, pos)
+            if not data:
+                break
+            self.wfile.write(data)
+            pos += len(data)
+
+
+class Server(ThreadingHTTPServer):
+    """Local HTTP server for one download, run in a background thread."""
+    daemon_threads = True
+
+    def __init__(self, download):
+        super().__init__(('127.0.0.1', 0), Handler)
+        self.download = download
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+        self.server_close()
+
+    @property
+    def url(self):
+        host, port = self.server_address
+        return f'http://{host}:{port}/'
+
+
+def play(enc, start=None):
+    """Start downloading enclosure and play it from the growing file at once.
+    The download goes on in the background after playback, and can be resumed
+    later if the program exits before it has finished. Return player exit
+    code.
+    """
+    download = Download(enc)
+    download.start()
+    with Server(download) as server:
+        return media.play_url(server.url, start=start)
@@ -0,0 +1,317 @@
+"""Entry query language.
+
+A query is a whitespace-separated list of terms that must all match. A term
+is a name, an operator, and a value; alternatives are separated by '|', and
+a leading '!' negates the term. Boolean terms have no operator or value.
+
+    flag=n|o      flag letters or names (also 'flag=no')
+    age<7         age in days (with <, <=, >, >=)
+    date>=2020-01-01
+    tag=news      tag present, or 'tag=key:value'
+    prio>=2       feed priority
+    lang=fi|en    language (also matches 'en-us')
+    dur>30        duration of downloaded files in minutes
+    file          some enclosure is downloaded
+    norm          all downloaded enclosures are normalized
+
+For example: 'flag=n|o lang=fi age<30 !file'.
+"""
+
+import bisect
+import datetime
+import logging
+import operator
+import re
+from collections import defaultdict
+
+from entry import Entry
+from misctypes import Flag
+
+log = logging.getLogger(__name__)
+
+OPERATORS = {'=': operator.eq, '!=': operator.ne, '<': operator.lt,
+             '<=': operator.le, '>': operator.gt, '>=': operator.ge}
+TERM_RE = re.compile(r'(!?)([a-zA-Z]+)(?:(!=|<=|>=|=|<|>)(.+))?$')
+ALIASES = dict(f='flag', p='prio', priority='prio', l='lang', t='tag',
+               d='dur', duration='dur')
+# Evaluation cost of terms, cheap ones are checked first.
+COSTS = dict(flag=0, prio=1, date=1, age=1, lang=2, tag=2, file=3, norm=4,
+             dur=5)
+
+
+class QueryError(ValueError):
+    """Invalid query."""
+
+
+class Term():
+    """Single query term, compiled into a predicate."""
+    def __init__(self, name, op=None, values=None, negate=False):
+        self.name = ALIASES.get(name, name)
+        self.op = op
+        self.values = values or []
+        self.negate = negate
+        if self.name not in COSTS:
+            raise QueryError(f'Unknown term: {name}')
+        self.check = getattr(self, f'_compile_{self.name}')()
+
+    def __str__(self):
+        s = '!' if self.negate else ''
+        s += self.name
+        if self.op is not None:
+            s += self.op + '|'.join(str(x) for x in self.values)
+        return s
+
+    @classmethod
+    def parse(cls, s):
+        m = TERM_RE.match(s.strip())
+        if m is None:
+            raise QueryError(f'Invalid term: {s}')
+        negate, name, op, value = m.groups()
+        values = value.split('|') if value is not None else []
+        return cls(name.lower(), op, values, negate=bool(negate))
+
+    @property
+    def cost(self):
+        return COSTS[self.name]
+
+    def ok(self, entry):
+        """Does entry match?"""
+        return self.check(entry) != self.negate
+
+    def _require(self, ops, boolean=False):
+        if boolean and self.op is None:
+            return
+        if self.op not in ops:
+            raise QueryError(f'Invalid operator for {self.name}: {self.op}')
+        if not self.values:
+            raise QueryError(f'Missing value: {self.name}')
+
+    def _single(self, convert):
+        """Return single value converted, for comparison operators."""
+        if len(self.values) != 1:
+            raise QueryError(f'Single value needed: {self}')
+        try:
+            return convert(self.values[0])
+        except ValueError:
+            raise QueryError(f'Invalid value: {self}')
+
+    def _compare(self, get, convert):
+        """Compile comparison of get(entry) with value."""
+        self._require(OPERATORS)
+        value = self._single(convert)
+        op = OPERATORS[self.op]
+
+        def check(entry):
+            x = get(entry)
+            return x is not None and op(x, value)
+        return check
+
+    def flags(self):
+        """Return set of flags of flag term."""
+        flags = set()
+        for value in self.values:
+            if value in Flag.__members__:
+                flags.add(Flag[value])
+                continue
+            try:
+                flags.update(Flag(x) for x in value)
+            except ValueError:
+                raise QueryError(f'Invalid flag: {value}')
+        return flags
+
+    def _compile_flag(self):
+        self._require(['=', '!='])
+        flags = self.flags()
+        if self.op == '!=':
+            return lambda entry: entry.flag not in flags
+        return lambda entry: entry.flag in flags
+
+    def _compile_age(self):
+        now = datetime.datetime.now()
+        inverse = {'<': '>', '<=': '>=', '>': '<', '>=': '<='}
+        self._require(inverse)
+        days = self._single(float)
+        # Age less than days means date greater than limit.
+        self.limit = now - datetime.timedelta(days=days)
+        self.date_op = inverse[self.op]
+        return self._compare_date()
+
+    def _compile_date(self):
+        self._require(OPERATORS)
+        self.limit = self._single(datetime.datetime.fromisoformat)
+        self.date_op = self.op
+        return self._compare_date()
+
+    def _compare_date(self):
+        op = OPERATORS[self.date_op]
+        return lambda entry: (entry.date is not None and
+                              op(entry.date, self.limit))
+
+    def _compile_prio(self):
+        return self._compare(lambda entry: entry.feed.priority, int)
+
+    def _compile_dur(self):
+        def minutes(entry):
+            duration = entry.duration()
+            if duration is None:
+                return None
+            return duration.total_seconds() / 60
+        return self._compare(minutes, float)
+
+    def tag_keys(self):
+        """Return list of (key, value or None) of tag term."""
+        return [tuple(x.split(':', 1)) if ':' in x else (x, None)
+                for x in self.values]
+
+    def _compile_tag(self):
+        self._require(['='])
+        keys = self.tag_keys()
+
+        def check(entry):
+            tags = entry.get_tags()
+            return any(k in tags and (v is None or tags[k] == v)
+                       for k, v in keys)
+        return check
+
+    def _compile_lang(self):
+        self._require(['='])
+        self.values = [x.lower() for x in self.values]  # Like language().
+        langs = set(self.values)
+        return lambda entry: language(entry) in langs
+
+    def _compile_file(self):
+        self._require([], boolean=True)
+        return lambda entry: any(x.status() is not None for x in entry.encs())
+
+    def _compile_norm(self):
+        self._require([], boolean=True)
+
+        def check(entry):
+            statuses = [x.status() for x in entry.encs()]
+            statuses = [x for x in statuses if x is not None]
+            return bool(statuses) and all(x.gain is not None for x in
+                                          statuses)
+        return check
+
+
+class Query():
+    """Compiled query: a conjunction of terms."""
+    def __init__(self, terms):
+        self.terms = sorted(terms, key=lambda x: x.cost)
+
+    def __str__(self):
+        return ' '.join(str(x) for x in self.terms) or '*'
+
+    @classmethod
+    def parse(cls, s):
+        """Parse query string. Raise QueryError if invalid."""
+        return cls([Term.parse(x) for x in (s or '').split()])
+
+    def ok(self, entry):
+        """Does entry match all terms?"""
+        return all(x.ok(entry) for x in self.terms)
+
+    def filter(self, entries):
+        """Return list of matching entries."""
+        return [x for x in entries if self.ok(x)]
+
+
+class Library():
+    """Secondary indexes of entries of many feeds by flag, date, tag, and
+    language, for finding matches without scanning every entry. Flag changes
+    are tracked; other indexed attributes are expected to stay put.
+    """
+    def __init__(self, feeds):
+        self.directories = set()
+        self.position = {}  # Entry id -> position, to keep feed order.
+        self.by_flag = defaultdict(set)  # Flag -> entry ids.
+        self.by_tag = defaultdict(set)  # Tag or (tag, value) -> entry ids.
+        self.by_lang = defaultdict(set)  # Language -> entry ids.
+        self.entries = {}  # Entry id -> entry.
+        dated = []
+        for feed in feeds:
+            self.directories.add(feed.directory)
+            for entry in feed.entries:
+                i = id(entry)
+                self.position[i] = len(self.position)
+                self.entries[i] = entry
+                self.by_flag[entry.flag].add(i)
+                for k, v in entry.get_tags().items():
+                    self.by_tag[k].add(i)
+                    self.by_tag[(k, v)].add(i)
+                self.by_lang[language(entry)].add(i)
+                if entry.date is not None:
+                    dated.append((entry.date, self.position[i], i))
+        dated.sort()
+        self.dates = [x[0] for x in dated]
+        self.dated_ids = [x[2] for x in dated]
+        Entry.flag_listeners.append(self.flag_changed)
+
+    def close(self):
+        """Stop tracking flag changes."""
+        if self.flag_changed in Entry.flag_listeners:
+            Entry.flag_listeners.remove(self.flag_changed)
+
+    def flag_changed(self, entry, old):
+        """Update flag index."""
+        i = id(entry)
+        if i in self.entries:
+            self.by_flag[old].discard(i)
+            self.by_flag[entry.flag].add(i)
+
+    def candidates(self, term):
+        """Return set of entry ids that may match term, or None if term
+        cannot use an index.
+        """
+        if term.negate:
+            return None
+        if term.name == 'flag' and term.op == '=':
+            return set().union(*(self.by_flag[x] for x in term.flags()))
+        if term.name == 'tag':
+            return set().union(*(self.by_tag[k if v is None else (k, v)]
+                                 for k, v in term.tag_keys()))
+        if term.name == 'lang':
+            return set().union(*(self.by_lang[x] for x in term.values))
+        if term.name in ['age', 'date']:
+            return set(self.dated_ids[slice(*self.date_range(term))])
+        return None
+
+    def date_range(self, term):
+        """Return index range of sorted dates matching date term."""
+        n = len(self.dates)
+        limit, op = term.limit, term.date_op
+        if op == '<':
+            return 0, bisect.bisect_left(self.dates, limit)
+        if op == '<=':
+            return 0, bisect.bisect_right(self.dates, limit)
+        if op == '>':
+            return bisect.bisect_right(self.dates, limit), n
+        if op == '>=':
+            return bisect.bisect_left(self.dates, limit), n
+        if op == '=':
+            return (bisect.bisect_left(self.dates, limit),
+                    bisect.bisect_right(self.dates, limit))
+        return 0, n  # Not equal: no help from index.
+
+    def select(self, query):
+        """Return dictionary of feed directory -> matching entries."""
+        sets = [self.candidates(x) for x in query.terms]
+        sets = sorted((x for x in sets if x is not None), key=len)
+        if sets:
+            ids = set.intersection(*sets)
+        else:
+            ids = self.entries.keys()
+        result = defaultdict(list)
+        for i in sorted(ids, key=self.position.get):
+            entry = self.entries[i]
+            if query.ok(entry):
+                result[entry.feed.directory].append(entry)
+        return result
+
+
+def language(entry):
+    """Return primary language code of entry, or None."""
+    lang = entry.get_tags().get('lang')
+    if not lang:
+        return None
+    return lang.split('-')[0].split('_')[0].lower()
@@ -0,0 +1,164 @@
+"""Content-addressed enclosure store."""
+
+import errno
+import fcntl
+import hashlib
+import logging
+import os
+import threading
+from pathlib import Path
+
+import pyutils.files
+
+import common
+
+log = logging.getLogger(__name__)
+
+_store = None  # The configured store, if any.
+
+
+class EnclosureStore():
+    """Enclosure files named by content hash, with the files in feed
+    directories being hardlinks to them. An index maps enclosure URLs to
+    content hashes, so that the same file is never downloaded or stored twice.
+
+    The store must be on the same filesystem as the feed directories.
+    """
+    def __init__(self, root):
+        self.root = Path(root)
+        self.index_path = self.root / 'index.json'
+        self.lock_path = self.root / 'index.lock'
+        self.lock = threading.Lock()
+        self.index = common.TextDict(self.index_path)  # URL -> digest.
+        self.added = {}  # Index additions not yet written.
+
+    def blob_path(self, digest):
+        """Return path of stored file."""
+        return self.root / 'objects' / digest[:2] / digest[2:]
+
+    def lookup(self, href):
+        """Return path of stored file for URL, or None."""
+        with self.lock:
+            digest = self.index.get(href)
+        if digest is not None:
+            path = self.blob_path(digest)
+            if path.exists():
+                return path
+        return None
+
+    def link(self, enc):
+        """Link enclosure path to stored file, if its URL is known. Return
+        True if done.
+        """
+        blob = self.lookup(enc.href)
+        if blob is None:
+            return False
+        pyutils.files.ensure_dir(enc.path)
+        try:
+            os.link(blob, enc.path)
+        except OSError as e:
+            log.error('Cannot link from store: %s: %s', enc.path, e)
+            return False
+        log.info('Linked from store: %s', enc.path)
+        return True
+
+    def add(self, path, href=None, write=True):
+        """Add file to store, replacing it with a hardlink if its content is
+        already there. Return number of bytes reclaimed.
+        """
+        digest = hash_file(path)
+        blob = self.blob_path(digest)
+        reclaimed = 0
+        try:
+            pyutils.files.ensure_dir(blob)
+            try:
+                os.link(path, blob)
+            except FileExistsError:  # Already there, maybe just added.
+                reclaimed = self._link_existing(path, blob)
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            log.error('Store on different filesystem: %s', path)
+            return 0
+        if href is not None:
+            with self.lock:
+                if self.index.get(href) != digest:
+                    self.index[href] = digest
+                    self.added[href] = digest
+            if write:
+                self.write()
+        return reclaimed
+
+    def _link_existing(self, path, blob):
+        """Replace file with a hardlink to stored file of same content.
+        A stored file of wrong size is replaced by the file instead. Return
+        number of bytes reclaimed.
+        """
+        if os.path.samefile(blob, path):
+            return 0
+        st = path.stat()
+        suffix = f'.{os.getpid()}.{threading.get_ident()}.tmp'
+        if blob.stat().st_size != st.st_size:
+            log.error('Replacing corrupt stored file: %s', blob)
+            tmp = blob.with_name(blob.name + suffix)
+            os.link(path, tmp)
+            os.replace(tmp, blob)
+            return 0
+        tmp = path.with_name(path.name + suffix)
+        os.link(blob, tmp)
+        os.replace(tmp, path)
+        log.info('Replaced duplicate with link: %s', path)
+        return st.st_size if st.st_nlink == 1 else 0
+
+    def prune(self):
+        """Remove stored files that are not linked from anywhere else. Return
+        number of bytes freed.
+        """
+        freed = 0
+        for path in self.root.glob('objects/*/*'):
+            st = path.stat()
+            if st.st_nlink == 1:
+                path.unlink()
+                freed += st.st_size
+        digests = {x.parent.name + x.name for x in
+                   self.root.glob('objects/*/*')}
+        with self.lock:
+            for href, digest in list(self.index.items()):
+                if digest not in digests:
+                    del self.index[href]
+        self.write(prune=True)
+        return freed
+
+    def write(self, prune=False):
+        """Write index, merging additions from concurrent processes unless
+        pruning.
+        """
+        pyutils.files.ensure_dir(self.index_path)
+        with self.lock, self.lock_path.open('a') as lockfile:
+            fcntl.flock(lockfile, fcntl.LOCK_EX)
+            if not prune:
+                self.index.clear()
+                self.index.read()
+                self.index.update(self.added)
+            self.index.write()
+            self.added.clear()
+
+
+def hash_file(path, chunk_size=1024**2):
+    """Return SHA-256 hex digest of file content."""
+    h = hashlib.sha256()
+    with open(path, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def configure(root):
+    """Set store directory. None disables the store."""
+    global _store
+    _store = None if root is None else EnclosureStore(root)
+
+
+def get_store():
+    """Return configured store, or None."""
+    return _store
@@ -0,0 +1,99 @@
+"""Synchronization of enclosures to a portable device."""
+
+import errno
+import hashlib
+import logging
+import os
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import media
+
+log = logging.getLogger(__name__)
+SUFFIX = '.opus'
+
+
+class TranscodeCache():
+    """Transcoded files named by source path, size, modification time, and
+    encoding settings, so that unchanged sources are never encoded again.
+    """
+    def __init__(self, root, bitrate='32k', apply_gain=True, max_age=30):
+        self.root = Path(root)
+        self.bitrate = bitrate
+        self.apply_gain = apply_gain  # Apply ReplayGain level, if any.
+        self.max_age = max_age  # Days to keep unused files.
+
+    def cache_path(self, src, gain=None):
+        """Return path of transcoded file for source."""
+        st = os.stat(src)
+        key = [os.path.abspath(src), st.st_size, st.st_mtime_ns, self.bitrate,
+               str(gain)]
+        digest = hashlib.sha256(repr(key).encode()).hexdigest()
+        return self.root / f'{digest}{SUFFIX}'
+
+    def get(self, src):
+        """Return transcoded file for source, transcoding if needed. Return
+        None on failure.
+        """
+        gain = media.get_gain(src) if self.apply_gain else None
+        path = self.cache_path(src, gain)
+        if path.exists():
+            log.debug('Using cached transcode: %s', src)
+            os.utime(path)  # Mark as used.
+            return path
+        self.root.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_suffix('.tmp')
+        try:
+            ok = media.transcode(src, tmp, bitrate=self.bitrate, gain=gain)
+        except FileNotFoundError as e:
+            log.error('Cannot transcode: %s', e)
+            ok = False
+        if not ok:
+            log.error('Transcoding failed: %s', src)
+            tmp.unlink(missing_ok=True)
+            return None
+        os.replace(tmp, path)
+        return path
+
+    def prune(self):
+        """Remove files not used for a while. Return number of bytes freed."""
+        freed = 0
+        limit = time.time() - self.max_age * 24 * 60 * 60
+        for path in self.root.glob(f'*{SUFFIX}'):
+            st = path.stat()
+            if st.st_mtime < limit:
+                path.unlink()
+                freed += st.st_size
+        return freed
+
+
+def sync(paths, dst, cache, jobs=1):
+    """Transcode media files concurrently, and replace files in destination
+    directory with them. Return list of files written.
+    """
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        results = list(executor.map(cache.get, paths))
+    dst = Path(dst)
+    dst.mkdir(parents=True, exist_ok=True)
+    for path in dst.iterdir():
+        if path.is_file():
+            path.unlink()
+    written = []
+    for src, path in zip(paths, results):
+        if path is None:
+            continue
+        target = dst / (Path(src).stem + SUFFIX)
+        i = 1
+        while target.exists():
+            i += 1
+            target = dst / f'{Path(src).stem}_{i}{SUFFIX}'
+        try:
+            os.link(path, target)
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            shutil.copyfile(path, target)  # Device on another filesystem.
+        written.append(target)
+    return written
@@ -3,9 +3,10 @@
 import datetime
 import logging
 import re
+import threading
 import webbrowser
 from contextlib import contextmanager
-from functools import lru_cache
+from itertools import chain
 try:
     from http import HTTPStatus
 except ImportError:
@@ -16,6 +17,7 @@ from statistics import mean
 from jupitotools.time import timedelta_floatdays
 
 import common
+import dirstate
 import fpapi
 import util
 from entry import Entry
@@ -57,11 +59,17 @@ class Head():
 class Feed():
     FEEDFILE = 'data.json'  # Feed information file.
     BAKEXT = '.bak'
+    write_lock = threading.RLock()  # Progress is written by player thread.
+    # Cached values and the attributes they are derived from.
+    DEPENDENCIES = dict(tags={'directory', 'head'},
+                        priority={'directory', 'head'},
+                        progress={'entries'})
 
     """Feed with entries."""
     def __init__(self, url, old_url=None, directory=None, parseinfo=None,
                  head=None, entries=None):
         """Create new feed."""
+        self._derived = util.DerivedValues(self.DEPENDENCIES)
         self.url = url
         self.old_url = old_url
         self.directory = Path(directory) if directory else None
@@ -74,6 +82,17 @@ class Feed():
     def __str__(self):
         return str(self.directory) or self.url
 
+    def __setattr__(self, name, value):
+        super().__setattr__(name, value)
+        if name != '_derived':
+            self.invalidate(name)
+
+    def invalidate(self, *attrs):
+        """Drop cached values derived from attributes (all if none given).
+        Assignments do this by themselves; changes in place must call it.
+        """
+        self._derived.invalidate(*attrs)
+
     def as_json(self):
         d = dict(
             url=self.url,
@@ -175,6 +194,7 @@ class Feed():
         if n_updates:
             log.debug('Updated %i entries in feed: %s', n_updates, self)
             self.entries.sort()
+            self.invalidate('entries')
         self.modified = True
         return n_updates
 
@@ -225,22 +245,30 @@ class Feed():
                 log.error('Invalid date order: %s', self)
         return sortkey
 
-    def list_entries(self, flags=None, sortkey=None, number=None):
-        """List entries of certain criteria.
+    def list_entries(self, flags=None, sortkey=None, number=None,
+                     entries=None):
+        """List entries of certain criteria, optionally among given entries
+        instead of all (for example, those matching a query).
 
         Wildcards are '.' for any flag, -1 for infinite number.
         """
-        entries = self.entries
+        if entries is None:
+            entries = self.entries
         # if flags is not None and '.' not in flags:
         #     entries = [x for x in entries if x.flag in flags]
         if flags:
             flags = [Flag(x) for x in flags]
             entries = [x for x in entries if x.flag in flags]
+        self._nentries = len(entries)
+        limited = number is not None and number != -1
         if sortkey is not None:
             sortkey = self.customize_sortkey(sortkey)
-            sort_entries(entries, sortkey)
-        self._nentries = len(entries)
-        if number is not None and number != -1:
+            if limited and number * 8 < len(entries):
+                # Usually only the first one or two are wanted.
+                entries = select_entries(entries, sortkey, number)
+            else:
+                sort_entries(entries, sortkey)
+        if limited:
             entries = entries[:number]
         return entries
 
@@ -308,7 +336,7 @@ class Feed():
 
     def get_orphans(self):
         """Return list of orphaned files in feed directory."""
-        dirfiles = {x.name for x in self.directory.iterdir()}
+        dirfiles = set(dirstate.snapshot(self.directory).names)
         p = Feed.data_path()
         datafiles = {str(p), str(p.with_suffix(p.suffix + self.BAKEXT))}
         encfiles = {enc.filename for entry in self.entries
@@ -321,9 +349,11 @@ class Feed():
         if self.head.link:
             webbrowser.open(self.head.link)
 
-    @lru_cache()
     def get_tags(self):
         """Get feed tags."""
+        return self._derived.get('tags', self._get_tags)
+
+    def _get_tags(self):
         tags = TagDict()
         for s in self.directory.parts:
             tags.parse(s)
@@ -337,13 +367,14 @@ class Feed():
         return tags
 
     @property
-    @lru_cache()
     def priority(self):
         """Get feed priority (tag p=n). Greater number => greater interest."""
-        try:
-            return int(self.get_tags()['p'])
-        except (KeyError, ValueError):
-            return 0
+        def get():
+            try:
+                return int(self.get_tags()['p'])
+            except (KeyError, ValueError):
+                return 0
+        return self._derived.get('priority', get)
 
     @classmethod
     def data_path(cls, directory=''):
@@ -351,13 +382,14 @@ class Feed():
         return Path(directory) / cls.FEEDFILE
 
     @property
-    @lru_cache()
     def progress(self):
         """Feed average progress."""
         # FIXME: This only looks at loaded entries, not all entries.
-        if not self.entries:
-            return 0
-        return mean(x.progress for x in self.entries)
+        def get():
+            if not self.entries:
+                return 0
+            return mean(x.progress for x in self.entries)
+        return self._derived.get('progress', get)
 
     @staticmethod
     def read(directory):
@@ -369,11 +401,12 @@ class Feed():
 
     def write(self, directory=None, force=False):
         """Write data."""
-        if self.modified or force:
-            if directory is None:
-                directory = self.directory
-            common.write_data(Feed.data_path(directory), self)
-            self.modified = False
+        with self.write_lock:
+            if self.modified or force:
+                if directory is None:
+                    directory = self.directory
+                common.write_data(Feed.data_path(directory), self)
+                self.modified = False
 
     @classmethod
     @contextmanager
@@ -413,21 +446,59 @@ def sort_entries(entries, sortkey):
     util.general_sort(entries, keys, reverses)
 
 
-def search_entries(entries, patterns, flags=re.IGNORECASE, start=0):
-    """Return index to first entry from start matching all RegExp patterns."""
-    def get_strings(entry):
-        """Return strings to match against."""
-        return list(filter(None, [str(entry.feed.directory),
-                                  entry.feed.head.title,
-                                  entry.feed.head.subtitle,
-                                  entry.feed.head.summary, entry.title,
-                                  entry.subtitle, entry.summary]))
-
-    def pattern_found(strings, pattern, flags):
-        """Try matching."""
-        # log.warning([strings, pattern])
-        return any(re.search(pattern, x, flags=flags) for x in strings)
-
-    for i, entry in enumerate(entries[start:], start):
-        if all(pattern_found(get_strings(entry), x, flags) for x in patterns):
+def select_entries(entries, sortkey, number):
+    """Return first number entries in order of sortkey string, without
+    sorting all of them.
+    """
+    keys = [SORTKEYS[x] for x in sortkey.lower()]
+    reverses = [x.isupper() for x in sortkey]
+    return util.general_nsmallest(entries, number, keys, reverses)
+
+
+def fold_pattern(pattern):
+    """Fold RegExp pattern like entry search text (see `util.fold_text()`),
+    leaving escapes like '\\S' as they are.
+    """
+    parts = re.split(r'(\\.)', util.fold_text(pattern, casefold=False),
+                     flags=re.DOTALL)
+    return ''.join(x if i % 2 else x.casefold() for i, x in enumerate(parts))
+
+
+def compile_patterns(patterns, flags=re.IGNORECASE):
+    """Compile RegExp patterns for matching entry search text."""
+    return [re.compile(fold_pattern(x), flags=flags) for x in patterns]
+
+
+def search_entries(entries, patterns, flags=re.IGNORECASE, start=0,
+                   wrap=False):
+    """Return index to first entry from start matching all RegExp patterns,
+    optionally wrapping around to the beginning.
+    """
+    regexps = compile_patterns(patterns, flags=flags)
+    indices = range(start, len(entries))
+    if wrap:
+        indices = chain(indices, range(min(start, len(entries))))
+    for i in indices:
+        text = entries[i].search_text()
+        if all(x.search(text) for x in regexps):
             return i
+    return None
+
+
+def count_matches(entries, patterns, flags=re.IGNORECASE):
+    """Return list of (index, number of matches) for entries matching all
+    RegExp patterns.
+    """
+    regexps = compile_patterns(patterns, flags=flags)
+    counts = []
+    for i, entry in enumerate(entries):
+        text = entry.search_text()
+        n = 0
+        for regexp in regexps:
+            hits = sum(1 for _ in regexp.finditer(text))
+            if not hits:
+                break
+            n += hits
+        else:
+            counts.append((i, n))
+    return counts
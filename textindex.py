@@ -0,0 +1,163 @@
+"""Persistent full-text index of feeds and entries."""
+
+import hashlib
+import logging
+import sqlite3
+from pathlib import Path
+
+from boltons.strutils import html2text
+
+from synd import Feed
+
+log = logging.getLogger(__name__)
+
+TIMEOUT = 30  # Seconds to wait for a concurrent writer, like another refresh.
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS feeds (directory TEXT PRIMARY KEY, stamp TEXT,
+                                  digest TEXT);
+CREATE TABLE IF NOT EXISTS docs (id INTEGER PRIMARY KEY, directory TEXT,
+                                 guid TEXT, date TEXT, title TEXT);
+CREATE INDEX IF NOT EXISTS docs_directory ON docs (directory);
+CREATE VIRTUAL TABLE IF NOT EXISTS text USING fts5(
+    feed, title, body, tokenize='unicode61 remove_diacritics 2');
+"""
+
+
+class SearchError(Exception):
+    """Search index cannot be used, or is locked for too long."""
+
+
+class TextIndex():
+    """SQLite FTS5 index of feed directory names and titles, and entry titles
+    and descriptions. Feeds are reread only when their data file changes,
+    and reindexed only when their text changes.
+    """
+    def __init__(self, path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            self.db = sqlite3.connect(str(self.path), timeout=TIMEOUT)
+        except sqlite3.Error as e:
+            raise SearchError(f'Cannot open search index: {e}')
+        try:
+            self.db.executescript(SCHEMA)
+        except sqlite3.Error as e:  # No FTS5 support, or locked.
+            self.db.close()
+            raise SearchError(f'Cannot create search index: {e}')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """Close database."""
+        self.db.close()
+
+    def sync(self, directories):
+        """Reindex feeds whose data has changed since last time. Return number
+        of feeds reindexed.
+        """
+        try:
+            return self._sync(directories)
+        except sqlite3.Error as e:
+            raise SearchError(f'Cannot update search index: {e}')
+
+    def _sync(self, directories):
+        rows = self.db.execute('SELECT directory, stamp, digest FROM feeds')
+        stored = {x[0]: x[1:] for x in rows}
+        n = 0
+        with self.db:
+            for directory in directories:
+                key = str(directory)
+                stamp = feed_stamp(directory)
+                old_stamp, old_digest = stored.get(key, (None, None))
+                if stamp == old_stamp:
+                    continue
+                if stamp is None:
+                    self._remove(key)
+                    continue
+                feed = Feed.read(directory)
+                digest = feed_digest(feed)
+                if digest != old_digest:
+                    self._remove(key)
+                    self._add(feed)
+                    n += 1
+                self.db.execute('INSERT OR REPLACE INTO feeds '
+                                'VALUES (?, ?, ?)', (key, stamp, digest))
+        if n:
+            log.info('Reindexed %i feeds', n)
+        return n
+
+    def _remove(self, key):
+        self.db.execute('DELETE FROM text WHERE rowid IN '
+                        '(SELECT id FROM docs WHERE directory = ?)', (key,))
+        self.db.execute('DELETE FROM docs WHERE directory = ?', (key,))
+        self.db.execute('DELETE FROM feeds WHERE directory = ?', (key,))
+
+    def _add(self, feed):
+        key = str(feed.directory)
+        feed_text = ' '.join(filter(None, [key, feed.head.title]))
+        for entry in feed.entries:
+            body = ' '.join(html2text(x).strip() for x in
+                            [entry.subtitle, entry.summary] if x)
+            cursor = self.db.execute(
+                'INSERT INTO docs (directory, guid, date, title) '
+                'VALUES (?, ?, ?, ?)',
+                (key, entry.guid, entry.date and entry.date.isoformat(),
+                 entry.title))
+            self.db.execute('INSERT INTO text (rowid, feed, title, body) '
+                            'VALUES (?, ?, ?, ?)',
+                            (cursor.lastrowid, feed_text, entry.title, body))
+
+    def search(self, terms, directories=None):
+        """Search entries matching all terms, best first. A term ending
+        with '*' is a prefix, a term with spaces a phrase. Return list of
+        (directory, guid, date, title), optionally only within directories.
+        """
+        expr = match_expression(terms)
+        if not expr:
+            return []
+        try:
+            rows = self.db.execute(
+                'SELECT d.directory, d.guid, d.date, d.title FROM text '
+                'JOIN docs AS d ON d.id = text.rowid WHERE text MATCH ? '
+                'ORDER BY rank', (expr,)).fetchall()
+        except sqlite3.Error as e:
+            raise SearchError(f'Cannot search: {e}')
+        if directories is None:
+            return rows
+        keys = {str(x) for x in directories}
+        return [x for x in rows if x[0] in keys]
+
+
+def feed_stamp(directory):
+    """Return feed data file size and modification time, or None if it does
+    not exist.
+    """
+    try:
+        st = Feed.data_path(directory).stat()
+    except FileNotFoundError:
+        return None
+    return f'{st.st_size}:{st.st_mtime_ns}'
+
+
+def feed_digest(feed):
+    """Return digest of indexed feed text."""
+    text = [str(feed.directory), feed.head.title]
+    for entry in feed.entries:
+        text += [entry.guid, str(entry.date), entry.title, entry.subtitle,
+                 entry.summary]
+    return hashlib.sha1(repr(text).encode()).hexdigest()
+
+
+def match_expression(terms):
+    """Return FTS5 query for terms, with each quoted as a literal."""
+    parts = []
+    for term in terms:
+        prefix = term.endswith('*')
+        term = term.rstrip('*').replace('"', '""').strip()
+        if term:
+            parts.append(f'"{term}"' + (' *' if prefix else ''))
+    return ' AND '.join(parts)
@@ -0,0 +1,191 @@
+"""Bandwidth limiting shared by all transfers of the process."""
+
+import datetime
+import logging
+import re
+import threading
+import time
+import urllib.request
+from pathlib import Path
+
+log = logging.getLogger(__name__)
+
+UNITS = dict(K=1024, M=1024**2, G=1024**3)
+
+
+class TokenBucket():
+    """Token bucket rate limiter that can be shared by threads. Rate is given
+    in bytes per second; None or zero means unlimited.
+    """
+    def __init__(self, rate=None, burst=1):
+        self.burst = burst  # Bucket size in seconds of rate.
+        self.lock = threading.Lock()
+        self.rate = None
+        self.tokens = 0
+        self.stamp = time.monotonic()
+        self.set_rate(rate)
+
+    def set_rate(self, rate):
+        """Change rate."""
+        with self.lock:
+            if rate != self.rate:
+                log.debug('Setting bandwidth limit to %s B/s', rate)
+                self.rate = rate or None
+                self.tokens = 0
+
+    def consume(self, n):
+        """Take n tokens, sleeping as long as needed to keep the rate. Large
+        requests put the bucket into debt, which later ones have to wait out.
+        """
+        with self.lock:
+            if self.rate is None:
+                return
+            now = time.monotonic()
+            self.tokens = min(self.rate * self.burst,
+                              self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+            self.tokens -= n
+            delay = -self.tokens / self.rate if self.tokens < 0 else 0
+        if delay:
+            time.sleep(delay)
+
+
+class Limiter():
+    """Global bandwidth limit with optional time-of-day schedule and live
+    adjustment. A rate written in the control file overrides the others, and
+    is re-read every few seconds.
+    """
+    def __init__(self, rate=None, schedule=None, control_path=None,
+                 interval=5):
+        self.rate = rate  # Default rate.
+        self.schedule = schedule or []  # List of (start, end, rate).
+        self.control_path = control_path
+        self.interval = interval  # Seconds between rate re-evaluations.
+        self.bucket = TokenBucket()
+        self.checked = None
+
+    def current_rate(self, now=None):
+        """Return rate in effect now."""
+        if self.control_path is not None:
+            try:
+                return parse_rate(Path(self.control_path).read_text())
+            except FileNotFoundError:
+                pass
+            except ValueError as e:
+                log.error('Invalid rate in %s: %s', self.control_path, e)
+        if now is None:
+            now = datetime.datetime.now().time()
+        for start, end, rate in self.schedule:
+            if start <= now < end or (end < start and (now >= start or
+                                                       now < end)):
+                return rate
+        return self.rate
+
+    def consume(self, n):
+        """Account for n transferred bytes, sleeping if over the limit."""
+        now = time.monotonic()
+        if self.checked is None or now - self.checked > self.interval:
+            self.checked = now
+            self.bucket.set_rate(self.current_rate())
+        self.bucket.consume(n)
+
+
+class ThrottledResponse():
+    """Wrapper for urllib response that throttles reading."""
+    def __init__(self, response):
+        self._response = response
+
+    def __getattr__(self, name):
+        return getattr(self._response, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return self._response.__exit__(*args)
+
+    def __iter__(self):
+        return iter(self.readline, b'')
+
+    def read(self, *args):
+        data = self._response.read(*args)
+        consume(len(data))
+        return data
+
+    def readline(self, *args):
+        data = self._response.readline(*args)
+        consume(len(data))
+        return data
+
+
+class ThrottleHandler(urllib.request.BaseHandler):
+    """Handler for urllib openers that throttles response reading."""
+    def http_response(self, request, response):
+        return ThrottledResponse(response)
+
+    https_response = http_response
+
+
+def parse_rate(s):
+    """Parse rate like '500K' or '2M' into bytes per second. Zero, empty, or
+    None means unlimited (None).
+    """
+    if s is None:
+        return None
+    m = re.fullmatch(r'\s*(\d+(?:\.\d+)?)\s*([KMG]?)\s*', s.upper())
+    if m is None:
+        raise ValueError(f'Invalid rate: {s}')
+    value, unit = m.groups()
+    return int(float(value) * UNITS.get(unit, 1)) or None
+
+
+def rate_arg(s):
+    """Check rate command line argument, and return it unparsed, so that
+    '0' (unlimited) stays distinct from no argument.
+    """
+    parse_rate(s)
+    return s
+
+
+def parse_schedule(s):
+    """Parse schedule like '08:00-23:00=500K,23:00-08:00=2M' into a list of
+    (start, end, rate). Time ranges may wrap around midnight.
+    """
+    def parse_time(x):
+        return datetime.datetime.strptime(x.strip(), '%H:%M').time()
+
+    schedule = []
+    for part in filter(None, (s or '').split(',')):
+        try:
+            times, rate = part.split('=')
+            start, end = times.split('-')
+            schedule.append((parse_time(start), parse_time(end),
+                             parse_rate(rate)))
+        except ValueError:
+            raise ValueError(f'Invalid schedule: {part}')
+    return schedule
+
+
+_limiter = Limiter()
+
+
+def configure(**kwargs):
+    """Set up the global limiter (see Limiter)."""
+    global _limiter
+    _limiter = Limiter(**kwargs)
+
+
+def consume(n):
+    """Account for n transferred bytes in the global limiter."""
+    _limiter.consume(n)
+
+
+def write_control(path, rate):
+    """Set live rate for running processes. None removes the override."""
+    path = Path(path)
+    if rate is None:
+        if path.exists():
+            path.unlink()
+    else:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(f'{rate}\n')
@@ -4,15 +4,20 @@
 
 import cmd
 import logging
+import re
 import shlex
 
 import pyutils.misc
 
 import common
+import fuzzy
+import prefetch
+import query
 import synd
+import textindex
 import util
 from common import View
-from misctypes import EntryFilter
+from player import PlayerError
 from synd import Flag
 
 log = logging.getLogger(__name__)
@@ -26,12 +31,21 @@ class UI(cmd.Cmd):
     # intro = 'Welcome'
     separator = ';'  # Separator for multiple commands on one line.
 
-    def __init__(self, proc, view=None):
+    def __init__(self, proc, view=None, prefetcher=None):
         super().__init__()
         self.proc = proc
         self.entries = None
         self._i = 0
         self._prev_i = None
+        self.direction = 1  # Direction of last move, for prefetching.
+        self._fuzzy = None  # Entry list and its fuzzy index.
+        self.prefetcher = prefetcher
+        self._own_prefetcher = prefetcher is None and proc.args.prefetch
+        if self._own_prefetcher:
+            self.prefetcher = prefetch.Prefetcher(
+                ahead=proc.args.prefetch,
+                budget=proc.args.prefetch_size * 1024**2,
+                maxsize=proc.args.maxsize)
         self.lastcmd = 'n'
         self.lastline = self.lastcmd
         self.n_cmds = 0  # Number of commands given, if several.
@@ -65,6 +79,7 @@ class UI(cmd.Cmd):
 
     def write_data(self, force=False):
         """Write data."""
+        common.apply_saved_progress(self.proc.open_feeds)
         feeds = self.proc.open_feeds.values()
         messager.msg(f'Writing {len(feeds)} feeds')
         for feed in feeds:
@@ -78,7 +93,12 @@ class UI(cmd.Cmd):
             if guid is not None or url is not None:
                 self.jump(guid, url)
         if self.entries:
-            self.cmdloop()
+            try:
+                self.cmdloop()
+            finally:
+                if self._own_prefetcher:
+                    messager.msg('Finishing prefetch')
+                    self.prefetcher.close()
         else:
             messager.msg('There are no entries. Bye!')
 
@@ -176,6 +196,21 @@ class UI(cmd.Cmd):
         x = pyutils.misc.truncate(self.get_row(self.i), reserved=len(s))
         return s.format(x=x)
 
+    def prefetch(self):
+        """Prefetch entries ahead of current one, if enabled."""
+        if self.prefetcher is not None and self.entries:
+            self.prefetcher.update(self.entries, self.i, self.direction)
+
+    def cancel_prefetch(self):
+        """Cancel queued prefetching when jumping away."""
+        if self.prefetcher is not None:
+            self.prefetcher.cancel()
+
+    def claim_entry(self):
+        """Make sure prefetcher is not working on current entry."""
+        if self.prefetcher is not None:
+            self.prefetcher.claim(self.entry)
+
     @property
     def intro(self):
         return f'Welcome: {len(self.entries)}'
@@ -200,6 +235,7 @@ class UI(cmd.Cmd):
 
     def precmd(self, line):
         # print('precmd "{}"'.format(line), self.lastline, self.n_cmds)
+        common.apply_saved_progress(self.proc.open_feeds)
         if not line:
             line = self.lastline
         lines = line.split(self.separator)
@@ -219,6 +255,8 @@ class UI(cmd.Cmd):
         if not self.entries:
             messager.msg('There are no entries. Bye!')
             return True
+        if not stop:
+            self.prefetch()
         return stop
 
     def do_EOF(self, arg):  # noqa: N802 (function name should be lowercase)
@@ -228,15 +266,18 @@ class UI(cmd.Cmd):
     def do_next(self, arg):
         """Move to next item in list."""
         delta = int(arg or 1)
+        self.direction = 1 if delta >= 0 else -1
         self.i += delta
 
     def do_back(self, arg):
         """Move to previous item in list."""
         delta = int(arg or 1)
+        self.direction = -1 if delta >= 0 else 1
         self.i -= delta
 
     def do_go(self, arg):
         """Go to indexed item."""
+        self.cancel_prefetch()
         if arg == '-':
             if self._prev_i is None:
                 messager.feedback('No previous location set.')
@@ -266,16 +307,101 @@ class UI(cmd.Cmd):
             self.i += cnt
 
     def do_search(self, arg):
-        """Search entries."""
+        """Search entries by RegExp patterns."""
         patterns = shlex.split(arg) or self.proc.session.get('search_patterns')
         if patterns:
-            i = synd.search_entries(self.entries, patterns, start=self.i+1)
-            if i is None:
-                messager.feedback(f'Not found: {patterns}')
-            else:
-                self.i = i
+            self.cancel_prefetch()
+            try:
+                i = synd.search_entries(self.entries, patterns,
+                                        start=self.i+1, wrap=True)
+            except re.error as e:
+                messager.feedback(f'Invalid pattern: {e}')
+                return
+            self.go_found(i, patterns)
             self.proc.session['search_patterns'] = patterns
 
+    def do_textsearch(self, arg):
+        """Search entries by full-text index, with terms like 'word',
+        'prefix*', or 'a phrase'.
+        """
+        terms = shlex.split(arg) or self.proc.session.get('search_terms')
+        if terms:
+            self.cancel_prefetch()
+            try:
+                i = self.search_index(terms, start=self.i+1)
+            except textindex.SearchError as e:
+                messager.feedback(e)
+                return
+            self.go_found(i, terms)
+            self.proc.session['search_terms'] = terms
+
+    def go_found(self, i, what):
+        """Go to entry found by search from current one, or tell why not."""
+        if i is None:
+            messager.feedback(f'Not found: {what}')
+        else:
+            if i <= self.i:
+                messager.feedback('Search wrapped to beginning.')
+            self.i = i
+
+    def search_index(self, terms, start=0):
+        """Return index to first entry from start found in full-text index,
+        wrapping around to the beginning.
+        """
+        found = {(x[0], x[1]) for x in self.proc.search(terms)}
+        n = len(self.entries)
+        for i in (x % n for x in range(start, start + n)):
+            entry = self.entries[i]
+            if (str(entry.feed.directory), entry.guid) in found:
+                return i
+        return None
+
+    def fuzzy_index(self):
+        """Return fuzzy search index of current entries."""
+        if self._fuzzy is None or self._fuzzy[0] is not self.entries:
+            self._fuzzy = self.entries, fuzzy.FuzzyIndex(self.entries)
+        return self._fuzzy[1]
+
+    def do_fuzzy(self, arg):
+        """Fuzzy search by entry and feed titles, and tags. Select one from
+        matches, ranked by similarity and entry score.
+        """
+        if not arg.strip():
+            messager.feedback('Argument needed.')
+            return
+        results = self.fuzzy_index().search(arg)
+        if not results:
+            messager.feedback(f'Not found: {arg}')
+            return
+        lines = (f'{score:3.0f} {self.get_row(i)}' for score, i in results)
+        out = pyutils.misc.peco(lines, index=True)
+        if out is not None:
+            self.do_go(results[int(out[0])][1])
+
+    def do_findall(self, arg):
+        """Find all entries matching RegExp patterns, and select one from
+        those, with the number of matches shown.
+        """
+        patterns = shlex.split(arg) or self.proc.session.get('search_patterns')
+        if not patterns:
+            messager.feedback('Argument needed.')
+            return
+        try:
+            counts = synd.count_matches(self.entries, patterns)
+        except re.error as e:
+            messager.feedback(f'Invalid pattern: {e}')
+            return
+        self.proc.session['search_patterns'] = patterns
+        if not counts:
+            messager.feedback(f'Not found: {patterns}')
+            return
+        messager.feedback(f'Found {sum(x[1] for x in counts)} matches in '
+                          f'{len(counts)} entries.')
+        lines = (f'{n:3} {self.get_row(i)}' for i, n in counts)
+        out = pyutils.misc.peco(lines, index=True)
+        if out is not None:
+            self.do_go(counts[int(out[0])][0])
+
     def do_view(self, arg):
         """Show info on entry."""
         verbose = 2
@@ -317,14 +443,21 @@ class UI(cmd.Cmd):
                 self.entry.set_flag(Flag.new)
                 self.feed.write()
             maxsize = int(arg or self.proc.args.maxsize)
+            self.claim_entry()
             common.download_enclosures(self.entry, maxsize=maxsize)
         except ValueError as e:
             messager.feedback(e)
 
+    def do_enqueue(self, arg):
+        """Add enclosures to download queue."""
+        n = self.proc.dlqueue.enqueue([self.entry])
+        messager.feedback(f'Queued {n} downloads.')
+
     def do_normalize(self, arg):
         """Normalize volume."""
         # force = bool(int(arg or 0))
         force = str_as_bool(arg, False)
+        self.claim_entry()
         common.download_enclosures(self.entry)
         common.normalize_enclosures(self.entry, force=force)
 
@@ -333,9 +466,40 @@ class UI(cmd.Cmd):
         # set_flag = bool(int(arg or 1))
         set_flag = str_as_bool(arg, True)
         # common.show_entry(self.entry, verbose=2)
+        self.claim_entry()
         common.download_enclosures(self.entry)
         common.normalize_enclosures(self.entry)
-        common.play_enclosures(self.entry, set_flag=set_flag)
+        common.play_enclosures(self.entry, set_flag=set_flag,
+                               player=self.proc.player)
+        self.feed.write()
+
+    def do_pause(self, arg):
+        """Toggle pause in persistent player."""
+        try:
+            if self.proc.player is None:
+                messager.feedback('No persistent player, use --mpv_ipc.')
+            else:
+                self.proc.player.pause()
+        except PlayerError as e:
+            messager.feedback(e)
+
+    def do_stop(self, arg):
+        """Stop persistent player."""
+        try:
+            if self.proc.player is not None:
+                self.proc.player.stop()
+        except PlayerError as e:
+            messager.feedback(e)
+
+    def do_playdl(self, arg):
+        """Play enclosures while downloading them, flag as open."""
+        set_flag = str_as_bool(arg, True)
+        if self.entry.flag == Flag.deleted:
+            messager.feedback('Flagging deleted entry as new.')
+            self.entry.set_flag(Flag.new)
+        self.claim_entry()
+        common.play_enclosures(self.entry, set_flag=set_flag,
+                               progressive=True)
         self.feed.write()
 
     def do_stream(self, arg):
@@ -351,6 +515,7 @@ class UI(cmd.Cmd):
         try:
             # set_flag = bool(int(arg or 1))
             set_flag = str_as_bool(arg, True)
+            self.claim_entry()
             common.remove_enclosures(self.entry, set_flag=set_flag)
             self.entry.feed.write()
         except ValueError as e:
@@ -400,23 +565,37 @@ class UI(cmd.Cmd):
         view = View(**d)
         view = view.parse(viewstring)
         messager.msg(f'Zooming to feed "{self.feed.directory}"')
-        ui = UI(self.proc, view=view)
+        self.cancel_prefetch()
+        ui = UI(self.proc, view=view, prefetcher=self.prefetcher)
         ui.run()
         messager.msg(f'Returning to {len(self.view.directory)} feeds')
 
     def do_update(self, arg):
         """Update view."""
         viewstring = arg or ''
-        self.view = self.view.parse(viewstring)
+        try:
+            view = self.view.parse(viewstring)
+            query.Query.parse(view.query)  # Check before use.
+        except ValueError as e:
+            messager.feedback(e)
+            return
+        self.view = view
         guid, url = self.entry.guid, self.feed.url
         self.read_data()
         self.jump(guid, url)
 
     def do_filter(self, arg):
-        """Filter results."""
-        flt = EntryFilter.parse(arg)
-        messager.feedback(f'Filtering by {flt}')
-        self.entries = list(filter(flt.ok, self.entries))
+        """Filter results by query (a number N stands for 'age<=N')."""
+        s = arg.strip() or '7'
+        if s.isdigit():
+            s = f'age<={s}'
+        try:
+            q = query.Query.parse(s)
+        except query.QueryError as e:
+            messager.feedback(e)
+            return
+        messager.feedback(f'Filtering by {q}')
+        self.entries = q.filter(self.entries)
 
     def do_sync(self, arg):
         """General synchronize."""
@@ -438,17 +617,22 @@ class UI(cmd.Cmd):
 
     do_b = do_back
     do_dl = do_download
+    do_dq = do_enqueue
     do_f = do_filter
+    do_fa = do_findall
+    do_fz = do_fuzzy
     do_g = do_go
     do_N = do_nextfeed
     do_l = do_list
     do_n = do_next
     do_nl = do_normalize
     do_p = do_play
+    do_pd = do_playdl
     do_q = do_quit = do_EOF
     do_rm = do_remove
     do_s = do_search
     do_setp = do_setprogress
+    do_ts = do_textsearch
     do_u = do_update
     do_v = do_view
     do_z = do_zoom
@@ -461,16 +645,17 @@ def encs_char(entry):
     nencs = len(encs)
     if not encs:
         return '-'
-    if any(x.path.exists() and x.size() == 0 for x in encs):  # Empty files.
+    statuses = [x.status() for x in encs]
+    if any(x is not None and x.size == 0 for x in statuses):  # Empty files.
         return '!'
     if nencs > 9:
         return '+'
-    ndownloaded = sum(x.path.exists() for x in encs)
+    ndownloaded = sum(x is not None for x in statuses)
     if ndownloaded == 0:
         return str(nencs)
     if nencs != ndownloaded:
         return chr(ord('a') + ndownloaded)
-    nnormalized = sum(x.is_normalized() for x in encs)
+    nnormalized = sum(x.gain is not None for x in statuses)
     return chr(ord('A') + nnormalized)
 
 
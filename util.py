@@ -1,12 +1,15 @@
 """Miscellaneous utility functionality."""
 
 import datetime
+import heapq
 import logging
 import pprint
+import re
 import shutil
 import sys
 import textwrap
 import time
+import unicodedata
 from html.parser import HTMLParser
 from pathlib import Path
 from statistics import mean, median, stdev
@@ -21,6 +24,10 @@ import pyutils.misc
 
 log = logging.getLogger(__name__)
 
+# Blocks of combining diacritical marks.
+COMBINING_RE = re.compile('[\u0300-\u036f\u1ab0-\u1aff\u1dc0-\u1dff'
+                          '\u20d0-\u20ff\ufe20-\ufe2f]')
+
 
 class AttrDict(dict):
     """Dictionary with attribute-like addressing."""
@@ -28,6 +35,36 @@ class AttrDict(dict):
     __setattr__ = dict.__setitem__
 
 
+class DerivedValues():
+    """Per-instance cache of values derived from attributes of an object.
+
+    A value is dropped when an attribute it depends on is invalidated, and
+    recomputed when its stamp (for state not kept in attributes) changes.
+    Unlike `functools.lru_cache` on methods, the cache goes with the object.
+    """
+    def __init__(self, dependencies=None):
+        self.dependencies = dependencies or {}  # Name -> attribute names.
+        self.values = {}  # Name -> (stamp, value).
+
+    def get(self, name, func, stamp=None):
+        """Return cached value, or compute it by func()."""
+        cached = self.values.get(name)
+        if cached is not None and cached[0] == stamp:
+            return cached[1]
+        value = func()
+        self.values[name] = stamp, value
+        return value
+
+    def invalidate(self, *attrs):
+        """Drop values depending on attributes, or all if none given."""
+        if not attrs:
+            self.values.clear()
+            return
+        for name, deps in self.dependencies.items():
+            if name in self.values and not deps.isdisjoint(attrs):
+                del self.values[name]
+
+
 class AppDirsPathlib(appdirs.AppDirs):
     """Convenience wrapper for AppDirs that returns Path objects."""
     def __getattribute__(self, name):
@@ -179,6 +216,15 @@ class HTMLStripper(HTMLParser):
         return parser.get_data()
 
 
+def fold_text(s, casefold=True):
+    """Remove accents (also 'ä' and 'ö'), and optionally casefold, for
+    forgiving text search.
+    """
+    if not s.isascii():
+        s = COMBINING_RE.sub('', unicodedata.normalize('NFKD', s))
+    return s.casefold() if casefold else s
+
+
 def month_letter(i):
     """Represent month as an easily graspable letter (a-f, o-t)."""
     # return ('abc' 'def' 'opq' 'rst')[i-1]
@@ -261,25 +307,48 @@ def timedelta_stats(deltas, funcs=None):
 
 def general_sort(lst, keys, reverses):
     """A more general version of list.sort() that supports a number of key
-    functions with independent reverse flags.
+    functions with independent reverse flags. Each key is evaluated once per
+    item, and items with None as key value are placed last.
     """
-    # for key, reverse in zip(keys, reverses):
-    #     values = sorted((key(x) for x in lst), reverse=reverse)
-    #     indices.append({v: i for i, v in enumerate(values)})
-
-    def indexmap(key, reverse):
-        """Create mapping from key(item) to index when sorted."""
-        values = sorted((key(x) for x in lst), reverse=reverse)
-        return {v: i for i, v in enumerate(values)}
-    maps = [indexmap(k, r) for k, r in zip(keys, reverses)]
-
-    def final_key(entry):
-        """Construct sortkey for list.sort()."""
-        return [m[k(entry)] for m, k in zip(maps, keys)]
-    lst.sort(key=final_key)
+    # Stable sorts from the least significant key, comparing plain values.
+    order = list(range(len(lst)))
+    for key, reverse in reversed(list(zip(keys, reverses))):
+        values = [key(x) for x in lst]
+        present = [i for i in order if values[i] is not None]
+        missing = [i for i in order if values[i] is None]
+        present.sort(key=values.__getitem__, reverse=reverse)
+        order = present + missing
+    lst[:] = [lst[i] for i in order]
     return lst
 
 
+def general_nsmallest(lst, n, keys, reverses):
+    """Return the first n items that general_sort() would give, selecting
+    them key by key with bounded heaps instead of sorting all items.
+    """
+    def select(items, n, keys, reverses):
+        """Return the first n items in any order."""
+        if n <= 0 or len(items) <= n or not keys:
+            return items[:max(n, 0)]
+        key, reverse = keys[0], reverses[0]
+        values = [key(x) for x in items]
+        present = [v for v in values if v is not None]
+        if len(present) >= n:
+            # Items better than the nth value are in, tied ones compete.
+            limit = (heapq.nlargest if reverse else heapq.nsmallest)(
+                n, present)[-1]
+            better = [x for x, v in zip(items, values) if v is not None and
+                      (v > limit if reverse else v < limit)]
+            tied = [x for x, v in zip(items, values) if v == limit]
+        else:
+            better = [x for x, v in zip(items, values) if v is not None]
+            tied = [x for x, v in zip(items, values) if v is None]
+        return better + select(tied, n - len(better), keys[1:], reverses[1:])
+
+    return general_sort(select(list(lst), n, keys, reverses), keys,
+                        reverses)
+
+
 # def slugify_filename(text, prefix='', suffix='', max_length=255):
 #     """Slugify filename using awesome-slugify library."""
 #     # TODO: Handle slug uniqueness (duplicate file names).